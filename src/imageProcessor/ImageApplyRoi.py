@@ -102,7 +102,7 @@ class ImageApplyRoi(ImageProcessorBase, ImageProcOutputInterface):
         # Signals end of stream
         self.signalEndOfStreams()
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
 
     def process_image(self, image_data, ts):
         self.refresh_frame_rate_in()
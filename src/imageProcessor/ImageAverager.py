@@ -143,7 +143,7 @@ class ImageAverager(ImageProcessorBase, ImageProcOutputInterface):
         # Signals end of stream
         self.signalEndOfStreams()
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
 
     def process_image(self, input_image, ts, first_image):
         try:
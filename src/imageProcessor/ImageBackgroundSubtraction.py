@@ -188,7 +188,7 @@ class ImageBackgroundSubtraction(ImageProcessorBase, ImageProcOutputInterface):
         # Signals end of stream
         self.signalEndOfStreams()
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
 
     def process_image(self, image_data, ts, first_image):
         self.refresh_frame_rate_in()
@@ -341,7 +341,7 @@ class ImageBackgroundSubtraction(ImageProcessorBase, ImageProcOutputInterface):
 
             except Exception as e:
                 msg = f"Exception in save: {e}"
-                self['status'] = msg
+                self.set_status(msg)
                 if self['state'] != State.ERROR:
                     self.updateState(State.ERROR)
                 raise
@@ -388,7 +388,7 @@ class ImageBackgroundSubtraction(ImageProcessorBase, ImageProcOutputInterface):
 
         except Exception as e:
             msg = f"Exception in load: {e}"
-            self['status'] = msg
+            self.set_status(msg)
             if self['state'] != State.ERROR:
                 self.updateState(State.ERROR)
             raise
@@ -304,4 +304,4 @@ class ImageCrosshair(ImageProcessorBase, ImageProcOutputInterface):
         # Signals end of stream
         self.signalEndOfStreams()
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
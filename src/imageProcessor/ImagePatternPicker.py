@@ -131,13 +131,14 @@ class ImagePatternPicker(PythonDevice):
         warn_train_id = self[f"{node}.warnTrainId"]
 
         if train_id > last_train_id:
-            if warn_train_id != 0 and time.time() - last_bad_tid_time > 1.:
+            elapsed = time.monotonic() - last_bad_tid_time
+            if warn_train_id != 0 and elapsed > 1.:
                 # no "bad" trainId received in the past 1 s
                 self[f"{node}.warnTrainId"] = 0  # remove warning
             status = "Processing"
             is_valid = True
         else:
-            self.last_bad_tid_time[node] = time.time()
+            self.last_bad_tid_time[node] = time.monotonic()
 
             if warn_train_id == 0:
                 self[f"{node}.warnTrainId"] = 1  # raise warning
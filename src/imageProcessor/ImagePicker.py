@@ -256,4 +256,4 @@ class ImagePicker(ImageProcessorBase, ImageProcOutputInterface):
         if not self.isActive():
             # Signals end of stream
             self.updateState(State.ON)
-            self['status'] = 'Idle'
+            self.set_status('Idle')
@@ -14,20 +14,26 @@ from image_processing import image_processing
 from karabo.bound import (
     BOOL_ELEMENT, DOUBLE_ELEMENT, FLOAT_ELEMENT, INT32_ELEMENT,
     KARABO_CLASSINFO, NODE_ELEMENT, OUTPUT_CHANNEL, SLOT_ELEMENT,
-    STRING_ELEMENT, VECTOR_DOUBLE_ELEMENT, VECTOR_INT32_ELEMENT, DaqDataType,
-    Dims, Hash, ImageData, MetricPrefix, Schema, State, Timestamp, Unit)
+    STRING_ELEMENT, UINT32_ELEMENT, VECTOR_DOUBLE_ELEMENT,
+    VECTOR_INT32_ELEMENT, DaqDataType, Dims, Hash, ImageData, MetricPrefix,
+    Schema, State, Timestamp, Unit)
 
 try:
     from ._version import version as deviceVersion
+    from .common import peak_parameters, sum_dtype
     from .ImageProcessorBase import ImageProcessorBase
 except ImportError:
     from imageProcessor._version import version as deviceVersion
+    from imageProcessor.common import peak_parameters, sum_dtype
     from imageProcessor.ImageProcessorBase import ImageProcessorBase
 
 
 class Average():
-    counter = 0
-    valueSum = 0.
+    __slots__ = ('counter', 'valueSum')
+
+    def __init__(self):
+        self.counter = 0
+        self.valueSum = 0.
 
     def append(self, value):
         self.valueSum += value
@@ -38,12 +44,240 @@ class Average():
         self.valueSum = 0.
 
     def mean(self):
-        return (self.valueSum / self.counter) if self.counter > 0 else np.nan
+        return self.valueSum / max(self.counter, 1)
 
     def __len__(self):
         return self.counter
 
 
+# Size (in bytes) of the chunks used for chunked image reductions. It
+# should fit in the L2 cache.
+CHUNK_BYTES = 1 << 18
+
+# Maximum length of the pixel value frequencies (imgBinCount)
+MAX_BIN_COUNT = 65535
+
+# The 2D gaussian fit of images with more pixels than this is first run on
+# the 2x2 binned image, in order to get good initial parameters.
+COARSE_FIT_MIN_PIXELS = 1 << 16
+
+# Reconfigurable properties used while processing the images. They are
+# cached in ImageProcessor._cfg, to avoid getting them at each frame.
+CONFIG_KEYS = (
+    "imagePath", "filterImagesByThreshold", "imageThreshold",
+    "absolutePositions", "subtractBkgImage", "subtractImagePedestal",
+    "doMinMaxMean", "doBinCount", "doXYSum", "doCOfM", "do1DFit", "do2DFit",
+    "doIntegration", "comRange", "userDefinedRange", "absThreshold",
+    "threshold", "pixelSize", "fitRange", "rangeForAuto", "enablePolynomial",
+    "lowPass.enable", "lowPass.windowLength", "lowPass.polyorder",
+    "fitMinSnr", "gauss1dStartValues", "doGaussRotation",
+    "warnOnFitOutOfBounds", "integrationRegion", "clipValues",
+    "thresholdRange",
+)
+
+# Gaussian fit parameters, kept between frames to seed the next fit.
+# The 2D parameters are in the order used by the fit functions, i.e.
+# (A, x0, y0, sx, sy, theta).
+FIT_PARAMS_DTYPE = np.dtype([
+    ('ax1d', 'f8'), ('x01d', 'f8'), ('sx1d', 'f8'),
+    ('ay1d', 'f8'), ('y01d', 'f8'), ('sy1d', 'f8'),
+    ('a2d', 'f8'), ('x02d', 'f8'), ('y02d', 'f8'),
+    ('sx2d', 'f8'), ('sy2d', 'f8'), ('theta2d', 'f8')])
+
+
+def min_max_mean(img, chunk_bytes=CHUNK_BYTES):
+    """Return min, max and mean pixel value of the image.
+
+    Integer images are reduced chunk by chunk, so that each chunk is read
+    from main memory only once and the three reductions run on cached data.
+    Their pixels are summed exactly, in int64. Floating point images are
+    reduced as a whole, which is faster and propagates NaN to min and max.
+    """
+    flat = img.reshape(-1)  # a view for contiguous images
+    chunk_size = max(chunk_bytes // flat.itemsize, 1)
+    if (flat.size <= chunk_size or flat.dtype.kind not in 'iu' or
+            flat.itemsize > 4):
+        return flat.min(), flat.max(), flat.mean()
+
+    img_min = img_max = flat[0]
+    img_sum = 0
+    for start in range(0, flat.size, chunk_size):
+        chunk = flat[start:start + chunk_size]
+        img_min = min(img_min, chunk.min())
+        img_max = max(img_max, chunk.max())
+        img_sum += chunk.sum(dtype=np.int64).item()
+
+    return img_min, img_max, img_sum / flat.size
+
+
+def cap_bin_count(px_freq, size):
+    """Return the pixel value frequencies with at most `size` bins.
+
+    The counts of the higher pixel values are added to the last bin, as if
+    the pixel values had been clipped to size - 1.
+    """
+    if px_freq.size > size:
+        px_freq[size - 1] += px_freq[size:].sum()
+        px_freq = px_freq[:size]
+    return px_freq
+
+
+def subtract_background(img, bkg, with_min=False, chunk_bytes=CHUNK_BYTES):
+    """Subtract the background from the image in place, clipping at zero.
+
+    The image is processed in panels of rows fitting in the L2 cache, thus
+    the minimum of the result can be evaluated while still in cache.
+
+    :param img: the image (or spectrum), modified in place
+    :param bkg: the background image, with the same shape
+    :param with_min: whether the minimum of the result shall be evaluated
+    :return: the minimum pixel value of the result, if with_min is True
+    """
+    rows = max(chunk_bytes // max(img[0].nbytes, 1), 1)
+    img_min = None
+    for start in range(0, img.shape[0], rows):
+        panel = img[start:start + rows]
+        bkg_panel = bkg[start:start + rows]
+        # After max(img, bkg), pixels below bkg become bkg - bkg = 0.
+        # This works for any dtype, w/o boolean masks.
+        np.maximum(panel, bkg_panel, out=panel, casting='unsafe')
+        np.subtract(panel, bkg_panel, out=panel, casting='unsafe')
+        if with_min:
+            panel_min = panel.min()
+            if img_min is None or panel_min < img_min:
+                img_min = panel_min
+    return img_min
+
+
+def sum_along_x(data, out=None):
+    """Return the image integral along the X-axis, in the dtype of out
+    (float64 by default).
+
+    :param out: optional buffer, as long as the image height, to be used
+    for the output. The sum is evaluated in its dtype.
+    """
+    if out is None:
+        out = np.empty(data.shape[0], dtype=np.float64)
+    return np.add.reduce(data, axis=1, dtype=out.dtype, out=out)
+
+
+def sum_along_y(data, out=None):
+    """Return the image integral along the Y-axis, in the dtype of out
+    (float64 by default).
+
+    :param out: optional buffer, as long as the image width, to be used
+    for the output. The sum is evaluated in its dtype.
+    """
+    if out is None:
+        out = np.empty(data.shape[1], dtype=np.float64)
+    return np.add.reduce(data, axis=0, dtype=out.dtype, out=out)
+
+
+def set_threshold(img, threshold, out=None):
+    """Return the image with the pixels below threshold set to 0.
+
+    :param img: the image (or spectrum), left untouched
+    :param threshold: the pixel threshold
+    :param out: optional buffer, with the shape and dtype of the image, to
+    be used for the output. If not given, a new array is returned.
+    """
+    if out is None:
+        out = np.empty_like(img)
+    out.fill(0)
+    np.copyto(out, img, where=img >= threshold)
+    return out
+
+
+def centre_of_mass(img, indices):
+    """Return centre-of-mass and widths of a 1D or 2D image.
+
+    :param img: the image (or spectrum)
+    :param indices: pixel indices and their squares, as returned by
+    ImageProcessor.pixel_indices. They must be at least as long as the
+    image width and height.
+    :return: (x0, y0, sx, sy) for 2D images, (x0, sx) for 1D ones
+    """
+    if img.ndim == 1:
+        return _distribution_moments(img, indices)
+
+    x0, sx = _distribution_moments(img.sum(axis=0, dtype=np.float64),
+                                   indices)
+    y0, sy = _distribution_moments(img.sum(axis=1, dtype=np.float64),
+                                   indices)
+    return x0, y0, sx, sy
+
+
+def _distribution_moments(distribution, indices):
+    idx, idx2 = indices
+    size = distribution.size
+    total = distribution.sum(dtype=np.float64)
+    x0 = np.dot(distribution, idx[:size]) / total
+    variance = np.dot(distribution, idx2[:size]) / total - x0 * x0
+    return x0, math.sqrt(max(variance, 0.))
+
+
+def bin_2x2(data):
+    """Return the 2D image binned by 2 in both directions (mean of 2x2
+    blocks), as float64. An odd last row or column is dropped.
+    """
+    height = data.shape[0] // 2
+    width = data.shape[1] // 2
+    blocks = data[:2 * height, :2 * width].reshape(height, 2, width, 2)
+    binned = blocks.sum(axis=(1, 3), dtype=np.float64)
+    binned *= 0.25
+    return binned
+
+
+def coarse_start_values(fit, data, p0, n_params, enable_polynomial):
+    """Return initial parameters for the 2D gaussian fit of large images.
+
+    The image is first fitted after 2x2 binning, i.e. on a quarter of the
+    pixels, and the result is scaled back to full resolution.
+
+    :param fit: the fit function, fitGauss or fitGauss2DRot
+    :param data: the image to be fitted
+    :param p0: initial parameters for the full resolution fit, or None
+    :param n_params: the number of gaussian parameters, 5 or 6 (rotation)
+    :param enable_polynomial: whether the fit has a polynomial term
+    :return: the refined initial parameters, or p0 if the image is small or
+    the binned fit fails
+    """
+    if data.size < COARSE_FIT_MIN_PIXELS:
+        return p0
+
+    if p0 is not None:
+        # Block k contains pixels 2k and 2k+1, i.e. it is centred at 2k+0.5
+        p0_c = ((p0[0], (p0[1] - 0.5) / 2, (p0[2] - 0.5) / 2, p0[3] / 2,
+                 p0[4] / 2) + tuple(p0[5:n_params]))
+    else:
+        p0_c = None
+    out = fit(bin_2x2(data), p0_c, enablePolynomial=enable_polynomial)
+    p_c, success = out[0], out[2]
+    if success not in (1, 2, 3, 4):
+        return p0
+
+    return ((p_c[0], 2 * p_c[1] + 0.5, 2 * p_c[2] + 0.5, 2 * p_c[3],
+             2 * p_c[4]) + tuple(p_c[5:n_params]))
+
+
+def _increase_range(low_val, high_val, maximum_val, target_range):
+    # Widen [low_val, high_val) to target_range, within [0, maximum_val)
+    missing = target_range - (high_val - low_val)
+    if missing > 0:
+        low_val = max(0, low_val - missing // 2)
+        missing = target_range - (high_val - low_val)
+        high_val = min(maximum_val, high_val + missing)
+        missing = target_range - (high_val - low_val)
+        if missing > 0:
+            low_val = max(0, low_val - missing)
+    return low_val, high_val
+
+
+def peak_snr(data):
+    """Return the peak signal-to-noise ratio of a 1D distribution"""
+    return data.max() / (data.std() + 1e-9)
+
+
 @KARABO_CLASSINFO("ImageProcessor", deviceVersion)
 class ImageProcessor(ImageProcessorBase):
     # Numerical factor to convert gaussian standard deviation to beam size
@@ -299,6 +533,18 @@ class ImageProcessor(ImageProcessorBase):
             .reconfigurable()
             .commit(),
 
+            FLOAT_ELEMENT(expected).key("fitMinSnr")
+            .displayedName("1D Fit Minimum SNR")
+            .description("The 1D gaussian fits are skipped if the peak "
+                         "signal-to-noise ratio (max/std) of the "
+                         "distribution is below this value. 0 disables "
+                         "the check.")
+            .assignmentOptional().defaultValue(0.)
+            .minInc(0.)
+            .unit(Unit.NUMBER)
+            .reconfigurable()
+            .commit(),
+
             STRING_ELEMENT(expected).key("gauss1dStartValues")
             .displayedName("1D gauss fit start values")
             .description("Selects how 1D gauss fit starting values are "
@@ -413,6 +659,14 @@ class ImageProcessor(ImageProcessorBase):
             .alarmHigh(65536).needsAcknowledging(False)
             .commit(),
 
+            UINT32_ELEMENT(expected).key("droppedFrames")
+            .displayedName("Dropped Frames")
+            .description("Number of input frames dropped, because the "
+                         "processing of the previous ones was not over.")
+            .unit(Unit.COUNT)
+            .readOnly().initialValue(0)
+            .commit(),
+
             # Image processing times
 
             FLOAT_ELEMENT(expected).key("minMaxMeanTime")
@@ -785,21 +1039,13 @@ class ImageProcessor(ImageProcessorBase):
         # always call superclass constructor first!
         super().__init__(configuration)
 
-        # 1d gaussian fit parameters
-        self.ax1d = None
-        self.x01d = None
-        self.sx1d = None
-        self.ay1d = None
-        self.y01d = None
-        self.sy1d = None
-
-        # 2d gaussian fit parameters
-        self.a2d = None
-        self.x02d = None
-        self.sx2d = None
-        self.y02d = None
-        self.sy2d = None
-        self.theta2d = None
+        # Gaussian fit parameters (NaN if not available)
+        self.fit_params = np.full(1, np.nan, dtype=FIT_PARAMS_DTYPE)
+        # Views on the 1D (x and y) and 2D fit parameters
+        params = self.fit_params.view(np.float64)
+        self.fit_x = params[0:3]  # A, x0, sx
+        self.fit_y = params[3:6]  # A, y0, sy
+        self.fit_2d = params[6:12]  # A, x0, y0, sx, sy, theta
 
         # Define good range for gaussian fit
         self.x_min = None
@@ -807,19 +1053,63 @@ class ImageProcessor(ImageProcessorBase):
         self.y_min = None
         self.y_max = None
 
+        # Image width, height and bpp of the current output schema
+        self._output_schema_key = None
+        # Maximum length of the pixel value frequencies, in the schema
+        self._bin_count_size = MAX_BIN_COUNT
+        # Set by onData at start of stream: the worker will update the warn
+        # levels and the output schema, in order with the frames it writes
+        self._new_stream = False
+
         # Current image
         self.current_image = None
 
+        # Image size, offsets and binning, as last published
+        self._geometry = None
+
+        # User ranges, clamped to the image size
+        self._ranges = {}
+
+        # Pixel indices (and their squares), used for centre-of-mass
+        self._pixel_indices = None
+
+        # Scratch buffers, re-used across frames
+        self._buffers = {}
+
+        # Device and output channel updates, re-used across frames
+        self._hash = Hash()
+        self._out_hash = Hash()
+
         # Background image
         self.bkg_image = None
 
+        # Zero values of the features' properties, published when a feature
+        # gets disabled; features whose properties are already zero
+        self.zero_values = {
+            "minMaxMean": Hash(
+                "minPxValue", 0.0, "maxPxValue", 0.0, "meanPxValue", 0.0),
+            "cOfM": Hash("x0", 0.0, "sx", 0.0, "y0", 0.0, "sy", 0.0),
+            "1dFit": Hash(
+                "xFitSuccess", 0, "ax1d", 0.0, "x01d", 0.0, "ex01d", 0.0,
+                "sx1d", 0.0, "esx1d", 0.0, "beamWidth1d", 0.0,
+                "yFitSuccess", 0, "ay1d", 0.0, "y01d", 0.0, "ey01d", 0.0,
+                "sy1d", 0.0, "esy1d", 0.0, "beamHeight1d", 0.0),
+            "2dFit": Hash(
+                "fitSuccess", 0, "a2d", 0.0, "x02d", 0.0, "ex02d", 0.0,
+                "sx2d", 0.0, "esx2d", 0.0, "beamWidth2d", 0.0,
+                "y02d", 0.0, "ey02d", 0.0, "sy2d", 0.0, "esy2d", 0.0,
+                "beamHeight2d", 0.0, "theta2d", 0.0, "etheta2d", 0.0),
+            "integration": Hash("regionIntegral", 0.0, "regionMean", 0.0),
+        }
+        self._zeroed = set()
+
         # Register additional slots
         self.KARABO_SLOT(self.reset)
         self.KARABO_SLOT(self.useAsBackgroundImage)
         # TODO: save/load bkg image slots
 
         # Processing time averages
-        self.last_update_time = time.time()
+        self.last_update_time = time.monotonic()
         self.averagers = {'minMaxMeanTime': Average(),
                           'binCountTime': Average(),
                           'subtractBkgImageTime': Average(),
@@ -831,6 +1121,8 @@ class ImageProcessor(ImageProcessorBase):
                           'fitTime': Average(),
                           'integrationTime': Average()
                           }
+        # The averagers are fixed: iterate them as a tuple
+        self._averager_items = tuple(self.averagers.items())
 
         # Register call-backs
         self.KARABO_ON_DATA("input", self.onData)
@@ -845,9 +1137,13 @@ class ImageProcessor(ImageProcessorBase):
             self.log.ERROR(msg)
             raise ValueError(msg)
 
+        # Cached configuration, updated in preReconfigure
+        self._cfg = {key: self[key] for key in CONFIG_KEYS}
+
     def initialization(self):
         """ This method will be called after the constructor. """
         self.reset()
+        self.start_worker(self.process_image)
 
     def preReconfigure(self, incomingReconfiguration):
         # always call ImageProcessorBase preReconfigure first!
@@ -859,7 +1155,12 @@ class ImageProcessor(ImageProcessorBase):
                 del incomingReconfiguration["userDefinedRange"]
                 msg = f"Invalid user defined range {udr} has been discarded."
                 self.log.WARN(msg)
-                self["status"] = msg
+                self.set_status(msg)
+
+        for key in CONFIG_KEYS:
+            if incomingReconfiguration.has(key):
+                self._cfg[key] = incomingReconfiguration[key]
+                self._ranges.pop(key, None)
 
     def is_user_range_valid(self, rng):
         return 0 <= rng[0] <= rng[1] and rng[2] <= rng[3]
@@ -870,69 +1171,29 @@ class ImageProcessor(ImageProcessorBase):
         self.bkg_image = np.array(self.current_image)
 
     def reset(self):
-        h = Hash()
-
-        h.set("minMaxMeanTime", 0.0)
-        h.set("binCountTime", 0.0)
-        h.set("subtractBkgImageTime", 0.0)
-        h.set("subtractPedestalTime", 0.0)
-        h.set("xYSumTime", 0.0)
-        h.set("cOfMTime", 0.0)
-        h.set("xFitTime", 0.0)
-        h.set("yFitTime", 0.0)
-        h.set("fitTime", 0.0)
-        h.set("integrationTime", 0.0)
-
-        h.set("minPxValue", 0.0)
-        h.set("maxPxValue", 0.0)
-        h.set("meanPxValue", 0.0)
-        h.set("x0", 0.0)
-        h.set("sx", 0.0)
-        h.set("y0", 0.0)
-        h.set("sy", 0.0)
-        h.set("xFitSuccess", 0)
-        h.set("ax1d", 0.0)
-        h.set("x01d", 0.0)
-        h.set("ex01d", 0.0)
-        h.set("sx1d", 0.0)
-        h.set("esx1d", 0.0)
-        h.set("beamWidth1d", 0.0)
-        h.set("yFitSuccess", 0)
-        h.set("ay1d", 0.0)
-        h.set("y01d", 0.0)
-        h.set("sy1d", 0.0)
-        h.set("beamHeight1d", 0.0)
-        h.set("fitSuccess", 0)
-        h.set("a2d", 0.0)
-        h.set("x02d", 0.0)
-        h.set("ex02d", 0.0)
-        h.set("sx2d", 0.0)
-        h.set("esx2d", 0.0)
-        h.set("beamWidth2d", 0.0)
-        h.set("y02d", 0.0)
-        h.set("ey02d", 0.0)
-        h.set("sy2d", 0.0)
-        h.set("esy2d", 0.0)
-        h.set("theta2d", 0.0)
-        h.set("etheta2d", 0.0)
-        h.set("beamHeight2d", 0.0)
-        h.set("regionIntegral", 0.0)
-        h.set("regionMean", 0.0)
-
-        h.set("inFrameRate", 0.)
-
+        self.frames_dropped = 0
         # Reset device parameters (all at once)
+        h = Hash(
+            # processing times
+            "minMaxMeanTime", 0.0, "binCountTime", 0.0,
+            "subtractBkgImageTime", 0.0, "subtractPedestalTime", 0.0,
+            "xYSumTime", 0.0, "cOfMTime", 0.0, "xFitTime", 0.0,
+            "yFitTime", 0.0, "fitTime", 0.0, "integrationTime", 0.0,
+            "inFrameRate", 0., "droppedFrames", 0)
+        # pixel values, centre-of-mass, gaussian fits and integration
+        for zero_values in self.zero_values.values():
+            h.merge(zero_values)
         self.set(h)
+        self._zeroed = set(self.zero_values)
 
     def onData(self, data, metaData):
-        first_image = False
         if self.get("state") == State.ON:
             self.log.INFO("Start of Stream")
             self.updateState(State.PROCESSING)
-            first_image = True
+            self._new_stream = True
 
         try:
-            image_path = self['imagePath']
+            image_path = self._cfg["imagePath"]
             if data.has(image_path):
                 image_data = data[image_path]
             else:
@@ -945,24 +1206,14 @@ class ImageProcessor(ImageProcessorBase):
                 dims = Dims(len(image_data))
                 image_data = ImageData(data, dims)
 
-            if first_image:
-                # Update warning levels
-                dims = image_data.getDimensions()
-                if len(dims) == 2:  # 2d
-                    image_height = dims[0]
-                    image_width = dims[1]
-                elif len(dims) == 1:  # 1d
-                    image_height = 1
-                    image_width = dims[0]
-                if self["warnOnFitOutOfBounds"]:
-                    self.update_warn_levels(0, image_height, 0, image_width)
-
-                bpp = image_data.getBitsPerPixel()
-                self.update_output_schema(image_height, image_width, bpp)
-
             ts = Timestamp.fromHashAttributes(
                 metaData.getAttributes('timestamp'))
-            self.process_image(image_data, ts)  # Process image
+
+            # Count all incoming frames, also the ones dropped later on
+            self.refresh_frame_rate_in()
+
+            # Process image in the worker thread
+            self.submit_to_worker(image_data, ts)
 
         except Exception as e:
             msg = f"Exception caught in onData: {e}"
@@ -970,38 +1221,40 @@ class ImageProcessor(ImageProcessorBase):
 
     def onEndOfStream(self, inputChannel):
         self.log.INFO("End of Stream")
+        self.wait_worker()  # Last frame has to be processed first
         self['inFrameRate'] = 0.
         # Signals end of stream
         self.signalEndOfStream("output")
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
 
     def process_image(self, imageData, ts):
 
-        def set_property(h, key, value):
-            if self[key] != value:
-                h[key] = value
+        zeroed = set()
 
-        filter_images_by_threshold = self.get("filterImagesByThreshold")
-        image_threshold = self.get("imageThreshold")
-        com_range = self.get("comRange")
-        fit_range = self.get("fitRange")
-        sigmas = self.get("rangeForAuto")
-        abs_thr = self.get("absThreshold")
-        thr = self.get("threshold")
-        user_defined_range = self.get("userDefinedRange")
-        absolute_positions = self.get("absolutePositions")
+        def set_zero(h, feature):
+            # Zero the feature's properties, unless already zero
+            if feature not in self._zeroed:
+                h.merge(self.zero_values[feature])
+                zeroed.add(feature)
 
-        h = Hash()  # Device properties updates
-        out_hash = Hash()  # Output channel updates
+        cfg = self._cfg
+        filter_images_by_threshold = cfg["filterImagesByThreshold"]
+        image_threshold = cfg["imageThreshold"]
+        com_range = cfg["comRange"]
+        fit_range = cfg["fitRange"]
+        sigmas = cfg["rangeForAuto"]
+        abs_thr = cfg["absThreshold"]
+        thr = cfg["threshold"]
+        user_defined_range = cfg["userDefinedRange"]
+        absolute_positions = cfg["absolutePositions"]
 
-        self.refresh_frame_rate_in()
+        h = self._hash  # Device properties updates
+        h.clear()
+        # Output channel updates: all its keys are set at each frame
+        out_hash = self._out_hash
 
-        try:
-            pixel_size = self.get("pixelSize")
-        except Exception:
-            # No pixel size
-            pixel_size = None
+        pixel_size = cfg["pixelSize"]
 
         try:
             dims = imageData.getDimensions()
@@ -1016,11 +1269,6 @@ class ImageProcessor(ImageProcessorBase):
             else:
                 self.log.DEBUG(f"Neither image nor spectrum: dims={dims}")
 
-            if image_width != self.get("imageWidth"):
-                h.set("imageWidth", image_width)
-            if image_height != self.get("imageHeight"):
-                h.set("imageHeight", image_height)
-
             roi_offsets = imageData.getROIOffsets()
             if is_2d_image:
                 image_offset_y = roi_offsets[0]
@@ -1028,10 +1276,6 @@ class ImageProcessor(ImageProcessorBase):
             else:
                 image_offset_y = 0
                 image_offset_x = roi_offsets[0]
-            if image_offset_x != self.get("imageOffsetX"):
-                h.set("imageOffsetX", image_offset_x)
-            if image_offset_y != self.get("imageOffsetY"):
-                h.set("imageOffsetY", image_offset_y)
 
             image_binning = imageData.getBinning()
             if is_2d_image:
@@ -1041,17 +1285,36 @@ class ImageProcessor(ImageProcessorBase):
                 image_binning_y = 1
                 image_binning_x = image_binning[0]
 
-            if image_binning_x != self.get("imageBinningX"):
-                h.set("imageBinningX", image_binning_x)
-            if image_binning_y != self.get("imageBinningY"):
-                h.set("imageBinningY", image_binning_y)
+            geometry = (image_width, image_height, image_offset_x,
+                        image_offset_y, image_binning_x, image_binning_y)
+            if geometry != self._geometry:
+                # Only published when it changes
+                self.set(Hash(
+                    "imageWidth", image_width, "imageHeight", image_height,
+                    "imageOffsetX", image_offset_x,
+                    "imageOffsetY", image_offset_y,
+                    "imageBinningX", image_binning_x,
+                    "imageBinningY", image_binning_y))
+                self._geometry = geometry
+                self._ranges.clear()
+
+            if self._new_stream:
+                # First frame of the stream processed
+                self._new_stream = False
+                if cfg["warnOnFitOutOfBounds"]:
+                    self.update_warn_levels(0, image_width, 0, image_height)
+                bpp = imageData.getBitsPerPixel()
+                self.update_output_schema(image_width, image_height, bpp)
 
             self.current_image = imageData.getData()  # np.ndarray
             img = self.current_image  # Shallow copy
             if img.ndim == 3 and img.shape[2] == 1:
                 # Image has 3rd dimension (channel), but it's 1
-                self.log.DEBUG("Reshaping image...")
-                img = img.squeeze()
+                img = img[..., 0]
+
+            # Convert once to C-contiguous layout, so that the following
+            # stages work on views (no copy if the image already is)
+            img = np.ascontiguousarray(img)
 
             self.log.DEBUG("Image loaded!!!")
 
@@ -1068,10 +1331,16 @@ class ImageProcessor(ImageProcessorBase):
                 return
 
         # Frequency of Pixel Values
-        if self.get("doBinCount"):
-            t0 = time.time()
+        if cfg["doBinCount"]:
+            t0 = time.perf_counter()
             try:
-                px_freq = image_processing.imagePixelValueFrequencies(img)
+                if img.dtype.kind == 'u' and img.dtype.itemsize <= 2:
+                    # 8/16-bit camera images: one pass histogram
+                    px_freq = np.bincount(img.reshape(-1))
+                else:
+                    px_freq = image_processing.imagePixelValueFrequencies(
+                        img)
+                px_freq = cap_bin_count(px_freq, self._bin_count_size)
 
                 self.log.DEBUG("Pixel values distribution: done!")
             except Exception as e:
@@ -1079,7 +1348,7 @@ class ImageProcessor(ImageProcessorBase):
                 self.update_count(error=True, status=msg)
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
             self.averagers["binCountTime"].append(t1 - t0)
 
             out_hash.set("data.imgBinCount", px_freq.tolist())
@@ -1087,8 +1356,9 @@ class ImageProcessor(ImageProcessorBase):
             out_hash.set("data.imgBinCount", [0])
 
         # Background image subtraction
-        if self.get("subtractBkgImage"):
-            t0 = time.time()
+        bkg_min = None
+        if cfg["subtractBkgImage"]:
+            t0 = time.perf_counter()
             try:
                 if (self.bkg_image is not None
                         and self.bkg_image.shape == img.shape):
@@ -1097,89 +1367,115 @@ class ImageProcessor(ImageProcessorBase):
                         # Must copy, or self.currentImage will be modified
                         self.current_image = img.copy()
 
-                    # Subtract background image
-                    m = (img > self.bkg_image)  # img is above bkg
-                    n = (img <= self.bkg_image)  # image is below bkg
-
-                    # subtract bkg from img, where img is above bkg
-                    img[m] -= self.bkg_image[m]
-                    img[n] = 0  # zero img, where its is below bkg
+                    # Subtract background image, clipping at zero. The
+                    # minimum is only needed by the pedestal subtraction.
+                    bkg_min = subtract_background(
+                        img, self.bkg_image,
+                        with_min=(cfg["subtractImagePedestal"] and
+                                  not cfg["doMinMaxMean"]))
 
             except Exception as e:
                 msg = f"Exception caught during background subtraction: {e}"
                 self.update_count(error=True, status=msg)
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
             self.averagers["subtractBkgImageTime"].append(t1 - t0)
             self.log.DEBUG("Background image subtraction: done!")
 
+        # Pixel min/max/mean values, evaluated once and shared with the
+        # pedestal subtraction
+        img_stats = None
+        if cfg["doMinMaxMean"]:
+            t0 = time.perf_counter()
+            try:
+                img_stats = min_max_mean(img)
+            except Exception as e:
+                msg = f"Exception caught whilst calculating min/max/mean: {e}"
+                self.update_count(error=True, status=msg)
+                return
+
+            t1 = time.perf_counter()
+            self.averagers["minMaxMeanTime"].append(t1 - t0)
+
         # Pedestal subtraction
-        if self.get("subtractImagePedestal"):  # was "doBackground"
-            t0 = time.time()
+        if cfg["subtractImagePedestal"]:  # was "doBackground"
+            t0 = time.perf_counter()
             try:
-                img_min = img.min()
+                if img_stats is not None:
+                    img_min = img_stats[0]
+                elif bkg_min is not None:
+                    img_min = bkg_min
+                else:
+                    img_min = img.min()
                 if img_min > 0:
                     if self.current_image is img:
                         # Must copy, or self.currentImage will be modified
                         self.current_image = img.copy()
 
                     # Subtract image pedestal
-                    img -= img_min
+                    np.subtract(img, img_min, out=img, casting='unsafe')
+                    if img_stats is not None:
+                        img_stats = (img_stats[0] - img_min,
+                                     img_stats[1] - img_min,
+                                     img_stats[2] - img_min)
 
             except Exception as e:
                 msg = f"Exception caught during pedestal subtraction: {e}"
                 self.update_count(error=True, status=msg)
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
             self.averagers["subtractPedestalTime"].append(t1 - t0)
             self.log.DEBUG("Image pedestal subtraction: done!")
 
         # Get pixel min/max/mean values
-        if self.get("doMinMaxMean"):
-            t0 = time.time()
-            try:
-                img_min = img.min()
-                img_max = img.max()
-                img_mean = img.mean()
-            except Exception as e:
-                msg = f"Exception caught whilst calculating min/max/mean: {e}"
-                self.update_count(error=True, status=msg)
-                return
-
-            t1 = time.time()
-            self.averagers["minMaxMeanTime"].append(t1 - t0)
-
+        if img_stats is not None:
+            self._zeroed.discard("minMaxMean")
+            img_min, img_max, img_mean = img_stats
             h.set("minPxValue", float(img_min))
             h.set("maxPxValue", float(img_max))
             h.set("meanPxValue", float(img_mean))
             self.log.DEBUG("Pixel min/max/mean: done!")
         else:
-            set_property(h, "minPxValue", 0.0)
-            set_property(h, "maxPxValue", 0.0)
-            set_property(h, "meanPxValue", 0.0)
+            set_zero(h, "minMaxMean")
+
+        # The region integration is always evaluated on the image as it is,
+        # thus in full precision
+        integration_img = img
+
+        # float64 images are analysed in float32, when at least two of the
+        # following stages read the whole image: the conversion reads 8 and
+        # writes 4 bytes per pixel, then each stage reads 4 instead of 8.
+        # Integer images are kept as they are, as converting them would
+        # rather increase the bytes.
+        if img.dtype == np.float64 and (
+                cfg["doXYSum"] + cfg["doCOfM"] + cfg["do1DFit"] +
+                cfg["do2DFit"]) >= 2:
+            img_f32 = self.scratch_buffer("img_f32", img.shape, np.float32)
+            np.copyto(img_f32, img, casting='same_kind')
+            img = img_f32
 
         # Sum the image along the x- and y-axes
         img_x = None
         img_y = None
-        if self.get("doXYSum") and is_2d_image:
-            t0 = time.time()
+        if cfg["doXYSum"] and is_2d_image:
+            t0 = time.perf_counter()
             try:
                 if com_range == "user-defined":
-                    x_min = np.maximum(user_defined_range[0], 0)
-                    x_max = np.minimum(user_defined_range[1], image_width)
-                    y_min = np.maximum(user_defined_range[2], 0)
-                    y_max = np.minimum(user_defined_range[3], image_height)
+                    x_min, x_max, y_min, y_max = self.clamped_range(
+                        "userDefinedRange", image_width, image_height)
                 else:
-                    x_min = 0
-                    x_max = image_width
-                    y_min = 0
-                    y_max = image_height
+                    x_min, x_max, y_min, y_max = (
+                        0, image_width, 0, image_height)
                 data = img[y_min:y_max, x_min:x_max]
                 # Sums along Y- and X-axes
-                img_x = image_processing.imageSumAlongY(data)
-                img_y = image_processing.imageSumAlongX(data)
+                img_x = sum_along_y(data, out=self.scratch_buffer(
+                    "img_x", (data.shape[1],),
+                    sum_dtype(data.dtype, data.shape[0])))
+                img_y = sum_along_x(data, out=self.scratch_buffer(
+                    "img_y", (data.shape[0],),
+                    sum_dtype(data.dtype, data.shape[1])))
 
                 # XXX possibly apply low-pass filter already here
 
@@ -1192,11 +1488,13 @@ class ImageProcessor(ImageProcessorBase):
                 self.log.WARN("Could not sum image along x or y axis.")
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
             self.averagers["xYSumTime"].append(t1 - t0)
 
-            out_hash.set("data.imgX", img_x.astype(np.float).tolist())
-            out_hash.set("data.imgY", img_y.astype(np.float).tolist())
+            out_hash.set("data.imgX",
+                         img_x.astype(np.float64, copy=False).tolist())
+            out_hash.set("data.imgY",
+                         img_y.astype(np.float64, copy=False).tolist())
             self.log.DEBUG("Image X-Y sums: done!")
         else:
             out_hash.set("data.imgX", [0.0])
@@ -1207,66 +1505,59 @@ class ImageProcessor(ImageProcessorBase):
         y0 = None
         sx = None
         sy = None
-        if self.get("doCOfM") or self.get("do1DFit") or self.get("do2DFit"):
-            t0 = time.time()
+        do_fit = cfg["do1DFit"] or (cfg["do2DFit"] and is_2d_image)
+        # The fits only need the CoM for the "auto" range, or as initial
+        # parameters when no last fit result is available
+        need_com = cfg["doCOfM"] or do_fit and (
+            fit_range == "auto" or self.fit_needs_com(is_2d_image))
+        if need_com:
+            self._zeroed.discard("cOfM")
+            t0 = time.perf_counter()
             try:
                 # Set a threshold to cut away noise
+                if img_stats is not None:
+                    img_max = img_stats[1]
+                else:
+                    img_max = img.max()
                 if abs_thr > 0.0:
-                    img2 = image_processing.\
-                        imageSetThreshold(img, min(abs_thr, img.max()),
-                                          copy=True)
-
+                    threshold = min(abs_thr, img_max)
                 else:
-                    img2 = image_processing.\
-                        imageSetThreshold(img, thr * img.max(), copy=True)
+                    threshold = thr * img_max
+                img2 = set_threshold(
+                    img, threshold,
+                    out=self.scratch_buffer("img2", img.shape, img.dtype))
 
                 # Centre-of-Mass and widths
+                indices = self.pixel_indices(max(image_width, image_height))
                 if is_2d_image:
                     if com_range == "user-defined":
                         img3 = img2[user_defined_range[2]:
                                     user_defined_range[3],
                                     user_defined_range[0]:
                                     user_defined_range[1]]
-                        x0, y0, sx, sy = image_processing.\
-                            imageCentreOfMass(img3)
+                        x0, y0, sx, sy = centre_of_mass(img3, indices)
                         x0 += user_defined_range[0]
                         y0 += user_defined_range[2]
                     else:  # "full"
-                        x0, y0, sx, sy = image_processing.\
-                            imageCentreOfMass(img2)
+                        x0, y0, sx, sy = centre_of_mass(img2, indices)
                 else:  # 1d
                     if com_range == "user-defined":
 
                         img3 = img2[user_defined_range[0]:
                                     user_defined_range[1]]
-                        (x0, sx) = image_processing.imageCentreOfMass(img3)
+                        (x0, sx) = centre_of_mass(img3, indices)
                         x0 += user_defined_range[0]
                     else:  # "full"
-                        (x0, sx) = image_processing.imageCentreOfMass(img2)
+                        (x0, sx) = centre_of_mass(img2, indices)
                     y0 = 0
                     sy = 0
 
-                if fit_range == "full":
-                    x_min = 0
-                    x_max = image_width
-                    y_min = 0
-                    y_max = image_height
-                elif fit_range == "user-defined":
-                    x_min = np.maximum(user_defined_range[0], 0)
-                    x_max = np.minimum(user_defined_range[1], image_width)
-                    y_min = np.maximum(user_defined_range[2], 0)
-                    y_max = np.minimum(user_defined_range[3], image_height)
-                    # TODO check that x_min<x_max and y_min<y_max
-                else:  # "auto"
-                    x_min, x_max, y_min, y_max = self.auto_fit_range(
-                        x0, y0, sx, sy, sigmas, image_width, image_height)
-
             except Exception as e:
                 msg = f"Exception caught whilst calculating CoM: {e}"
                 self.update_count(error=True, status=msg)
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
             self.averagers["cOfMTime"].append(t1 - t0)
 
             if absolute_positions:
@@ -1279,25 +1570,39 @@ class ImageProcessor(ImageProcessorBase):
             h.set("sy", sy)
             self.log.DEBUG("Centre-of-mass and widths: done!")
 
-        else:
-            set_property(h, "x0", 0.0)
-            set_property(h, "sx", 0.0)
-            set_property(h, "y0", 0.0)
-            set_property(h, "sx", 0.0)
+        elif not do_fit:
+            set_zero(h, "cOfM")
+        # else: the fits did not need the CoM, the last one is kept
+
+        # Fit range
+        if do_fit:
+            if fit_range == "full":
+                x_min, x_max, y_min, y_max = 0, image_width, 0, image_height
+            elif fit_range == "user-defined":
+                x_min, x_max, y_min, y_max = self.clamped_range(
+                    "userDefinedRange", image_width, image_height)
+                # TODO check that x_min<x_max and y_min<y_max
+            else:  # "auto"
+                x_min, x_max, y_min, y_max = self.auto_fit_range(
+                    x0, y0, sx, sy, sigmas, image_width, image_height)
 
         # 1D Gaussian Fits
-        if self.get("do1DFit"):
-            enable_low_pass = self.get("lowPass.enable")
-            window_length = self.get("lowPass.windowLength")
-            polyorder = self.get("lowPass.polyorder")
-            enable_polynomial = self.get("enablePolynomial")
-            gauss1d_start_values = self.get("gauss1dStartValues")
-
-            t0 = time.time()
+        if cfg["do1DFit"]:
+            self._zeroed.discard("1dFit")
+            enable_low_pass = cfg["lowPass.enable"]
+            window_length = cfg["lowPass.windowLength"]
+            polyorder = cfg["lowPass.polyorder"]
+            enable_polynomial = cfg["enablePolynomial"]
+            gauss1d_start_values = cfg["gauss1dStartValues"]
+            fit_min_snr = cfg["fitMinSnr"]
+
+            t0 = time.perf_counter()
             try:
                 if img_x is None:
                     if is_2d_image:
-                        img_x = image_processing.imageSumAlongY(img)
+                        img_x = sum_along_y(img, out=self.scratch_buffer(
+                            "img_x", (image_width,),
+                            sum_dtype(img.dtype, image_height)))
                     else:
                         img_x = img
 
@@ -1311,47 +1616,53 @@ class ImageProcessor(ImageProcessorBase):
                     # Low-pass filter
                     data = savgol_filter(data, window_length, polyorder)
 
-                # Initial parameters
-                if gauss1d_start_values == "raw_peak":
-                    # evaluate peak parameters w/o fit
-                    p0 = self.eval_starting_point(data)
-                elif gauss1d_start_values == "last_fit_result":
-                    if None not in (self.ax1d, self.x01d, self.sx1d):
-                        # Use last fit's parameters as initial estimate
-                        p0 = (self.ax1d, self.x01d - x_min, self.sx1d)
-                    elif None not in (x0, sx):
-                        # Use CoM for initial parameter estimate
-                        p0 = (data.max(), x0 - x_min, sx)
-                    else:
-                        # No initial parameters
-                        p0 = None
-                        # TODO "p0=self.eval_starting_point(data)" may be used
-                        # as well, once it's well tested
+                if fit_min_snr > 0 and peak_snr(data) < fit_min_snr:
+                    # Flat distribution: fit would not converge
+                    success_x = 0
                 else:
-                    raise RuntimeError("unexpected gauss1dStartValues option")
+                    # Initial parameters
+                    if gauss1d_start_values == "raw_peak":
+                        # evaluate peak parameters w/o fit
+                        p0 = self.eval_starting_point(data)
+                    elif gauss1d_start_values == "last_fit_result":
+                        if not np.isnan(self.fit_x).any():
+                            # Use last fit's parameters as initial estimate
+                            p0 = self.fit_x - (0., x_min, 0.)
+                        elif None not in (x0, sx):
+                            # Use CoM for initial parameter estimate
+                            p0 = (data.max(), x0 - x_min, sx)
+                        else:
+                            # No initial parameters
+                            p0 = None
+                            # TODO "p0=self.eval_starting_point(data)" may
+                            # be used as well, once it's well tested
+                    else:
+                        raise RuntimeError("unexpected gauss1dStartValues "
+                                           "option")
 
-                # 1D gaussian fit
-                out = image_processing.fitGauss(
-                    data, p0, enablePolynomial=enable_polynomial)
-                p_x = out[0]  # parameters
-                c_x = out[1]  # covariance
-                success_x = out[2]  # error
+                    # 1D gaussian fit
+                    out = image_processing.fitGauss(
+                        data, p0, enablePolynomial=enable_polynomial)
+                    p_x = out[0]  # parameters
+                    c_x = out[1]  # covariance
+                    success_x = out[2]  # error
 
-                # Save fit's parameters
-                self.ax1d, self.x01d, self.sx1d = (p_x[0], p_x[1] + x_min,
-                                                   p_x[2])
+                    # Save fit's parameters
+                    self.fit_x[:] = p_x[0], p_x[1] + x_min, p_x[2]
 
             except Exception as e:
                 msg = f"Exception caught during gaussian fit [x]: {e}"
                 self.update_count(error=True, status=msg)
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
 
             if is_2d_image:
                 try:
                     if img_y is None:
-                        img_y = image_processing.imageSumAlongX(img)
+                        img_y = sum_along_x(img, out=self.scratch_buffer(
+                            "img_y", (image_height,),
+                            sum_dtype(img.dtype, image_width)))
 
                     # Select sub-range and substract pedestal
                     data = img_y[y_min:y_max]
@@ -1363,44 +1674,48 @@ class ImageProcessor(ImageProcessorBase):
                         # Low-pass filter
                         data = savgol_filter(data, window_length, polyorder)
 
-                    # Initial parameters
-                    if gauss1d_start_values == "raw_peak":
-                        # evaluate peak parameters w/o fit
-                        p0 = self.eval_starting_point(data)
-                    elif gauss1d_start_values == "last_fit_result":
-                        if None not in (self.ay1d, self.y01d, self.sy1d):
-                            # Use last fit's parameters as initial estimate
-                            p0 = (self.ay1d, self.y01d - y_min, self.sy1d)
-                        elif None not in (y0, sy):
-                            # Use CoM for initial parameter estimate
-                            p0 = (data.max(), y0 - y_min, sy)
-                        else:
-                            # No initial parameters
-                            p0 = None
-                            # TODO may use "p0=self.eval_starting_point(data)"
-                            # as well, once it's well tested
-
+                    if fit_min_snr > 0 and peak_snr(data) < fit_min_snr:
+                        # Flat distribution: fit would not converge
+                        success_y = 0
                     else:
-                        raise RuntimeError("unexpected gauss1dStartValues "
-                                           "option")
+                        # Initial parameters
+                        if gauss1d_start_values == "raw_peak":
+                            # evaluate peak parameters w/o fit
+                            p0 = self.eval_starting_point(data)
+                        elif gauss1d_start_values == "last_fit_result":
+                            if not np.isnan(self.fit_y).any():
+                                # Use last fit's parameters as initial estimate
+                                p0 = self.fit_y - (0., y_min, 0.)
+                            elif None not in (y0, sy):
+                                # Use CoM for initial parameter estimate
+                                p0 = (data.max(), y0 - y_min, sy)
+                            else:
+                                # No initial parameters
+                                p0 = None
+                                # TODO may use
+                                # "p0=self.eval_starting_point(data)"
+                                # as well, once it's well tested
 
-                    # 1D gaussian fit
-                    out = image_processing.fitGauss(
-                        data, p0, enablePolynomial=enable_polynomial)
-                    p_y = out[0]  # parameters
-                    c_y = out[1]  # covariance
-                    success_y = out[2]  # error
+                        else:
+                            raise RuntimeError("unexpected gauss1dStartValues "
+                                               "option")
 
-                    # Save fit's parameters
-                    self.ay1d, self.y01d, self.sy1d = (p_y[0], p_y[1] + y_min,
-                                                       p_y[2])
+                        # 1D gaussian fit
+                        out = image_processing.fitGauss(
+                            data, p0, enablePolynomial=enable_polynomial)
+                        p_y = out[0]  # parameters
+                        c_y = out[1]  # covariance
+                        success_y = out[2]  # error
+
+                        # Save fit's parameters
+                        self.fit_y[:] = p_y[0], p_y[1] + y_min, p_y[2]
 
                 except Exception as e:
                     msg = f"Exception caught during gaussian fit [y]: {e}"
                     self.update_count(error=True, status=msg)
                     return
 
-                t2 = time.time()
+                t2 = time.perf_counter()
 
             self.averagers["xFitTime"].append(t1 - t0)
             h.set("xFitSuccess", success_x)
@@ -1411,9 +1726,7 @@ class ImageProcessor(ImageProcessorBase):
                 if c_x is None:
                     self.log.WARN("Successful X fit with singular covariance "
                                   "matrix. Resetting initial fit values.")
-                    self.ax1d = None
-                    self.x01d = None
-                    self.sx1d = None
+                    self.fit_x[:] = np.nan
 
                 try:
                     if absolute_positions:
@@ -1454,9 +1767,7 @@ class ImageProcessor(ImageProcessorBase):
                         self.log.WARN("Successful Y fit with singular "
                                       "covariance matrix."
                                       " Resetting initial fit values.")
-                        self.ay1d = None
-                        self.y01d = None
-                        self.sy1d = None
+                        self.fit_y[:] = np.nan
 
                     try:
                         if absolute_positions:
@@ -1498,25 +1809,15 @@ class ImageProcessor(ImageProcessorBase):
 
             self.log.DEBUG("1D gaussian fit: done!")
         else:
-            set_property(h, "xFitSuccess", 0)
-            set_property(h, "ax1d", 0.0)
-            set_property(h, "x01d", 0.0)
-            set_property(h, "ex01d", 0.0)
-            set_property(h, "sx1d", 0.0)
-            set_property(h, "esx1d", 0.0)
-            set_property(h, "beamWidth1d", 0.0)
-            set_property(h, "yFitSuccess", 0)
-            set_property(h, "ay1d", 0.0)
-            set_property(h, "y01d", 0.0)
-            set_property(h, "sy1d", 0.0)
-            set_property(h, "beamHeight1d", 0.0)
+            set_zero(h, "1dFit")
 
         # 2D Gaussian Fits
-        rotation = self.get("doGaussRotation")
-        if self.get("do2DFit") and is_2d_image:
-            enable_polynomial = self.get("enablePolynomial")
+        rotation = cfg["doGaussRotation"]
+        if cfg["do2DFit"] and is_2d_image:
+            self._zeroed.discard("2dFit")
+            enable_polynomial = cfg["enablePolynomial"]
 
-            t0 = time.time()
+            t0 = time.perf_counter()
             try:
                 # Input data
                 data = img[y_min:y_max, x_min:x_max]
@@ -1527,16 +1828,20 @@ class ImageProcessor(ImageProcessorBase):
                 if rotation:
 
                     # Initial parameters
-                    if None not in (self.a2d, self.x02d, self.y02d,
-                                    self.sx2d, self.sy2d, self.theta2d):
+                    if not np.isnan(self.fit_2d).any():
                         # Use last fit's parameters as initial estimate
-                        p0 = (self.a2d, self.x02d - x_min, self.y02d - y_min,
-                              self.sx2d, self.sy2d, self.theta2d)
-                    elif None not in (x0, y0, sx, sy):
-                        # Use CoM for initial parameter estimate
-                        p0 = (data.max(), x0 - x_min, y0 - y_min, sx, sy, 0.0)
+                        p0 = self.fit_2d - (0., x_min, y_min, 0., 0., 0.)
                     else:
-                        p0 = None
+                        if None not in (x0, y0, sx, sy):
+                            # Use CoM for initial parameter estimate
+                            p0 = (data.max(), x0 - x_min, y0 - y_min, sx, sy,
+                                  0.0)
+                        else:
+                            p0 = None
+                        # Refine them on the binned image
+                        p0 = coarse_start_values(
+                            image_processing.fitGauss2DRot, data, p0, 6,
+                            enable_polynomial)
 
                     # 2D gaussian fit
                     out = image_processing.fitGauss2DRot(
@@ -1546,24 +1851,26 @@ class ImageProcessor(ImageProcessorBase):
                     success_xy = out[2]  # error
 
                     # Save fit's parameters
-                    self.a2d, self.x02d, self.y02d, self.sx2d, self.sy2d = (
-                        p_xy[0], p_xy[1] + x_min, p_xy[2] + y_min, p_xy[3],
-                        p_xy[4])
-                    self.theta2d = p_xy[5]
+                    self.fit_2d[:] = (p_xy[0], p_xy[1] + x_min,
+                                      p_xy[2] + y_min, p_xy[3], p_xy[4],
+                                      p_xy[5])
 
                 else:
 
                     # Initial parameters
-                    if None not in (self.a2d, self.x02d, self.y02d,
-                                    self.sx2d, self.sy2d):
+                    if not np.isnan(self.fit_2d[:5]).any():
                         # Use last fit's parameters as initial estimate
-                        p0 = (self.a2d, self.x02d - x_min, self.y02d - y_min,
-                              self.sx2d, self.sy2d)
-                    elif None not in (x0, y0, sx, sy):
-                        # Use CoM for initial parameter estimate
-                        p0 = (data.max(), x0 - x_min, y0 - y_min, sx, sy)
+                        p0 = self.fit_2d[:5] - (0., x_min, y_min, 0., 0.)
                     else:
-                        p0 = None
+                        if None not in (x0, y0, sx, sy):
+                            # Use CoM for initial parameter estimate
+                            p0 = (data.max(), x0 - x_min, y0 - y_min, sx, sy)
+                        else:
+                            p0 = None
+                        # Refine them on the binned image
+                        p0 = coarse_start_values(
+                            image_processing.fitGauss, data, p0, 5,
+                            enable_polynomial)
 
                     # 2D gaussian fit
                     out = image_processing.fitGauss(
@@ -1573,16 +1880,15 @@ class ImageProcessor(ImageProcessorBase):
                     success_xy = out[2]  # error
 
                     # Save fit's parameters
-                    self.a2d, self.x02d, self.y02d, self.sx2d, self.sy2d = (
-                        p_xy[0], p_xy[1] + x_min, p_xy[2] + y_min, p_xy[3],
-                        p_xy[4])
+                    self.fit_2d[:5] = (p_xy[0], p_xy[1] + x_min,
+                                       p_xy[2] + y_min, p_xy[3], p_xy[4])
 
             except Exception as e:
                 msg = f"Exception caught during 2D gaussian fit: {e}"
                 self.update_count(error=True, status=msg)
                 return
 
-            t1 = time.time()
+            t1 = time.perf_counter()
 
             self.averagers["fitTime"].append(t1 - t0)
             h.set("fitSuccess", success_xy)
@@ -1594,13 +1900,9 @@ class ImageProcessor(ImageProcessorBase):
                 if c_xy is None:
                     self.log.WARN("Successful XY fit with singular covariance "
                                   "matrix. Resetting initial fit values.")
-                    self.a2d = None
-                    self.x02d = None
-                    self.y02d = None
-                    self.sx2d = None
-                    self.sy2d = None
+                    self.fit_2d[:5] = np.nan
                     if rotation:
-                        self.theta2d = None
+                        self.fit_2d[5] = np.nan
 
                 if absolute_positions:
                     h.set("x02d",
@@ -1642,50 +1944,36 @@ class ImageProcessor(ImageProcessorBase):
 
             self.log.DEBUG("2D gaussian fit: done!")
         else:
-            set_property(h, "fitSuccess", 0)
-            set_property(h, "a2d", 0.0)
-            set_property(h, "x02d", 0.0)
-            set_property(h, "ex02d", 0.0)
-            set_property(h, "sx2d", 0.0)
-            set_property(h, "esx2d", 0.0)
-            set_property(h, "beamWidth2d", 0.0)
-            set_property(h, "y02d", 0.0)
-            set_property(h, "ey02d", 0.0)
-            set_property(h, "sy2d", 0.0)
-            set_property(h, "esy2d", 0.0)
-            set_property(h, "beamHeight2d", 0.0)
-            set_property(h, "theta2d", 0.0)
-            set_property(h, "etheta2d", 0.0)
+            set_zero(h, "2dFit")
 
         # Region Integration
         integration_done = False
-        if self['doIntegration']:
+        if cfg["doIntegration"]:
+            self._zeroed.discard("integration")
             try:
-                t0 = time.time()
-                integrationRegion = self.get("integrationRegion")
-                x_min = np.maximum(integrationRegion[0], 0)
-                x_max = np.minimum(integrationRegion[1], image_width)
-                y_min = np.maximum(integrationRegion[2], 0)
-                y_max = np.minimum(integrationRegion[3], image_height)
+                t0 = time.perf_counter()
+                x_min, x_max, y_min, y_max = self.clamped_range(
+                    "integrationRegion", image_width, image_height)
                 if is_2d_image:
-                    data = img[y_min:y_max, x_min:x_max]
+                    data = integration_img[y_min:y_max, x_min:x_max]
                 else:
-                    data = img[x_min:x_max]
+                    data = integration_img[x_min:x_max]
 
-                if self.get("clipValues"):
-                    thresholdRange = self.get("thresholdRange")
+                if cfg["clipValues"]:
+                    thresholdRange = cfg["thresholdRange"]
                     mask = thresholdRange[0] <= data
-                    mask *= data <= thresholdRange[1]
-                    data_size = np.float64(np.sum(mask))
-                    data = data * mask
+                    mask &= data <= thresholdRange[1]
+                    data_size = np.count_nonzero(mask)
+                    integral = data.sum(dtype=np.float64, where=mask)
                 else:
                     data_size = data.size
+                    integral = data.sum(dtype=np.float64)
 
-                integral = np.float64(np.sum(data))
+                integral = float(integral)
                 h.set("regionIntegral", integral)
                 region_mean = integral / data_size if data_size > 0 else 0.0
                 h.set("regionMean", region_mean)
-                t1 = time.time()
+                t1 = time.perf_counter()
                 self.averagers["integrationTime"].append(t1 - t0)
                 integration_done = True
                 self.log.DEBUG("Region integration: done!")
@@ -1695,25 +1983,86 @@ class ImageProcessor(ImageProcessorBase):
                 return
 
         if not integration_done:
-            set_property(h, "regionIntegral", 0.0)
-            set_property(h, "regionMean", 0.0)
+            set_zero(h, "integration")
 
-        if time.time() - self.last_update_time > self.averaging_time_interval:
+        now = time.monotonic()
+        if now - self.last_update_time > self.averaging_time_interval:
             # average processing times over 1 second
-            for key, averager in self.averagers.items():
+            times = []
+            for key, averager in self._averager_items:
                 if averager:
-                    h.set(key, averager.mean())
+                    times += (key, averager.mean())
                     averager.clear()
+            if times:
+                # Merged into the device update at once
+                h.merge(Hash(*times))
 
-            self.last_update_time = time.time()
+            self.last_update_time = now
 
-        # Update device parameters (all at once)
-        self.set(h, ts)
         self.writeChannel("output", out_hash, ts)
-        self.update_count()  # Success
+        self.update_count(h=h)  # Success
+
+        # Update device parameters, error count included (all at once)
+        self.set(h, ts)
+        self._zeroed |= zeroed
+
+    def pixel_indices(self, size):
+        """Return the pixel indices and their squares, for the
+        centre-of-mass evaluation. They are only re-evaluated when the image
+        gets larger than the cached ones.
+        """
+        if self._pixel_indices is None or self._pixel_indices[0].size < size:
+            idx = np.arange(size, dtype=np.float64)
+            self._pixel_indices = (idx, idx * idx)
+        return self._pixel_indices
+
+    def scratch_buffer(self, key, shape, dtype):
+        """Return a scratch buffer for the given key. A new one is only
+        allocated when shape or dtype change.
+        """
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buffer
+        return buffer
+
+    def clamped_range(self, key, image_width, image_height):
+        """Return the range in the configuration key, clamped to the image
+        size. It is cached until the key is reconfigured or the image size
+        changes.
+        """
+        rng = self._ranges.get(key)
+        if rng is None:
+            user_range = self._cfg[key]
+            rng = (max(user_range[0], 0), min(user_range[1], image_width),
+                   max(user_range[2], 0), min(user_range[3], image_height))
+            self._ranges[key] = rng
+        return rng
+
+    def fit_needs_com(self, is_2d_image):
+        """Return True if the enabled gaussian fits will use the
+        centre-of-mass as initial parameters, i.e. if there is no last fit
+        result to start from.
+        """
+        if (self._cfg["do1DFit"] and
+                self._cfg["gauss1dStartValues"] == "last_fit_result"):
+            if np.isnan(self.fit_x).any():
+                return True
+            if is_2d_image and np.isnan(self.fit_y).any():
+                return True
+
+        if self._cfg["do2DFit"] and is_2d_image:
+            if self._cfg["doGaussRotation"]:
+                fit_2d = self.fit_2d
+            else:
+                fit_2d = self.fit_2d[:5]
+            if np.isnan(fit_2d).any():
+                return True
+
+        return False
 
     def eval_starting_point(self, data):
-        fit_ampl, peak_pixel, fwhm = image_processing.peakParametersEval(data)
+        fit_ampl, peak_pixel, fwhm = peak_parameters(data)
 
         return fit_ampl, peak_pixel, fwhm / self.gauss_2_fwhm
 
@@ -1721,50 +2070,29 @@ class ImageProcessor(ImageProcessorBase):
         new_schema = Schema()
         needs_update = False
 
-        if x_min != self.x_min or x_max != self.x_max:
+        def add_position_element(axis, fit, low, high):
+            key = f"{axis}0{fit.lower()}"  # e.g. "x01d"
             (
-                DOUBLE_ELEMENT(new_schema).key("x01d")
-                .displayedName("x0 (1D Fit)")
-                .description("x0 from 1D Fit.")
+                DOUBLE_ELEMENT(new_schema).key(key)
+                .displayedName(f"{axis}0 ({fit} Fit)")
+                .description(f"{axis}0 from {fit} Fit.")
                 .unit(Unit.PIXEL)
                 .readOnly()
-                .warnLow(x_min).needsAcknowledging(False)
-                .warnHigh(x_max).needsAcknowledging(False)
-                .commit(),
-
-                DOUBLE_ELEMENT(new_schema).key("x02d")
-                .displayedName("x0 (2D Fit)")
-                .description("x0 from 2D Fit.")
-                .unit(Unit.PIXEL)
-                .readOnly()
-                .warnLow(x_min).needsAcknowledging(False)
-                .warnHigh(x_max).needsAcknowledging(False)
+                .warnLow(low).needsAcknowledging(False)
+                .warnHigh(high).needsAcknowledging(False)
                 .commit(),
             )
+
+        if x_min != self.x_min or x_max != self.x_max:
+            for fit in ("1D", "2D"):
+                add_position_element("x", fit, x_min, x_max)
             self.x_min = x_min
             self.x_max = x_max
             needs_update = True
 
         if y_min != self.y_min or y_max != self.y_max:
-            (
-                DOUBLE_ELEMENT(new_schema).key("y01d")
-                .displayedName("y0 (1D Fit)")
-                .description("y0 from 1D Fit.")
-                .unit(Unit.PIXEL)
-                .readOnly()
-                .warnLow(y_min).needsAcknowledging(False)
-                .warnHigh(y_max).needsAcknowledging(False)
-                .commit(),
-
-                DOUBLE_ELEMENT(new_schema).key("y02d")
-                .displayedName("y0 (2D Fit)")
-                .description("y0 from 2D Fit.")
-                .unit(Unit.PIXEL)
-                .readOnly()
-                .warnLow(y_min).needsAcknowledging(False)
-                .warnHigh(y_max).needsAcknowledging(False)
-                .commit(),
-            )
+            for fit in ("1D", "2D"):
+                add_position_element("y", fit, y_min, y_max)
             self.y_min = y_min
             self.y_max = y_max
             needs_update = True
@@ -1773,6 +2101,11 @@ class ImageProcessor(ImageProcessorBase):
             self.appendSchema(new_schema)
 
     def update_output_schema(self, width, height, bpp):
+        if (width, height, bpp) == self._output_schema_key:
+            # Output schema is already up-to-date
+            return
+
+        bin_count_size = min(MAX_BIN_COUNT, 2**bpp)
         new_schema = Schema()
         output_data = Schema()
         (
@@ -1785,7 +2118,7 @@ class ImageProcessor(ImageProcessorBase):
             .displayedName("Pixel counts distribution")
             .description("Distribution of the image pixel counts.")
             .unit(Unit.NUMBER)
-            .maxSize(min(65535, 2**bpp))
+            .maxSize(bin_count_size)
             .readOnly().initialValue([0])
             .commit(),
 
@@ -1810,29 +2143,25 @@ class ImageProcessor(ImageProcessorBase):
         )
 
         self.appendSchema(new_schema)
+        self._output_schema_key = (width, height, bpp)
+        self._bin_count_size = bin_count_size
 
     @staticmethod
     def auto_fit_range(x0, y0, sx, sy, sigmas, image_width, image_height,
                        min_range=10):
+        # Python floats and ints: the CoM comes as numpy scalars
+        x0 = float(x0)
+        y0 = float(y0)
+        dx = sigmas * float(sx)
+        dy = sigmas * float(sy)
 
-        def increase_range(low_val, high_val, maximum_val, target_range):
-            missing = target_range - (high_val - low_val)
-            if missing > 0:
-                low_val = np.maximum(0, low_val - missing // 2)
-                missing = target_range - (high_val - low_val)
-                high_val = np.minimum(maximum_val, high_val + missing)
-                missing = target_range - (high_val - low_val)
-                if missing > 0:
-                    low_val = np.maximum(0, low_val - missing)
-            return low_val, high_val
-
-        x_min = np.maximum(int(x0 - sigmas * sx), 0)
-        x_max = np.minimum(int(x0 + sigmas * sx), image_width)
-        y_min = np.maximum(int(y0 - sigmas * sy), 0)
-        y_max = np.minimum(int(y0 + sigmas * sy), image_height)
+        x_min = max(int(x0 - dx), 0)
+        x_max = min(int(x0 + dx), image_width)
+        y_min = max(int(y0 - dy), 0)
+        y_max = min(int(y0 + dy), image_height)
 
         # ensure that auto range contains at least min_range pixels
-        x_min, x_max = increase_range(x_min, x_max, image_width, min_range)
-        y_min, y_max = increase_range(y_min, y_max, image_height, min_range)
+        x_min, x_max = _increase_range(x_min, x_max, image_width, min_range)
+        y_min, y_max = _increase_range(y_min, y_max, image_height, min_range)
 
         return x_min, x_max, y_min, y_max
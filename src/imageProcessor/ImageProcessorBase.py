@@ -4,6 +4,9 @@
 # Copyright (C) European XFEL GmbH Schenefeld. All rights reserved.
 #############################################################################
 
+import threading
+from queue import Empty, Full, Queue
+
 from karabo.bound import (
     DOUBLE_ELEMENT, IMAGEDATA_ELEMENT, INPUT_CHANNEL, KARABO_CLASSINFO,
     NODE_ELEMENT, OVERWRITE_ELEMENT, SLOT_ELEMENT, STRING_ELEMENT,
@@ -155,12 +158,29 @@ class ImageProcessorBase(PythonDevice):
 
         configuration['status'] = 'Idle'
 
+        # Last published status, error count, fraction and warn condition.
+        # They are updated from both the input channel and the worker
+        # thread, thus protected by a lock, as is the error counter.
+        self._count_lock = threading.Lock()
+        self._last_status = 'Idle'
+        self._last_count = 0
+        self._last_fraction = 0.
+        self._last_warn = 0
+
         # Variables for frames per second computation
         self.frame_rate_in = RateCalculator(refresh_interval=1.0)
 
+        # Worker thread, processing the incoming frames
+        self._worker = None
+        self._worker_queue = None
+        self.frames_dropped = 0
+
         # Register additional slots
         self.KARABO_SLOT(self.resetError)
 
+    def preDestruction(self):
+        self.stop_worker()
+
     def preReconfigure(self, configuration):
         need_refresh = False
 
@@ -176,66 +196,164 @@ class ImageProcessorBase(PythonDevice):
 
         if need_refresh:
             # warn level has to be re-evaluated
-            h = Hash()
-            self.evaluate_warn(h)
-            if not h.empty():
-                self.set(h)
+            with self._count_lock:
+                h = Hash()
+                self.evaluate_warn(h)
+                if not h.empty():
+                    self.set(h)
 
     def resetError(self):
         self.log.INFO("Called 'Reset Error'")
 
-        h = Hash('status', "Called 'Reset Error'")
-        self.error_counter.clear()
-        self.evaluate_warn(h)
-        self.set(h)
+        status = "Called 'Reset Error'"
+        with self._count_lock:
+            h = Hash('status', status)
+            self._last_status = status
+            self.error_counter.clear()
+            self.evaluate_warn(h)
+            self.set(h)
 
         if self['state'] != State.ON:
             self.updateState(State.ON)
 
-    def update_count(self, error=False, status="Processing"):
+    def update_count(self, error=False, status="Processing", h=None):
         """ Update success/error counting, as well as warn level.
 
         :param error: depending on this flag, one count will be added either
         to errors, or to successes
         :param status: the new status to be set and logged
+        :param h: if given, the changes are merged into this Hash, which
+        the caller will set in the device, instead of being set here
         :return:
         """
-        h = Hash()
+        update = Hash() if h is None else h
 
-        self.error_counter.append(error)
-        self.evaluate_warn(h)
+        with self._count_lock:
+            self.error_counter.append(error)
+            self.evaluate_warn(update)
 
-        if self['status'] != status:
-            h['status'] = status
-            if error:
-                self.log.ERROR(status)
-            else:
-                self.log.INFO(status)
+            # Compare to the last published status, not to the device one
+            if self._last_status != status:
+                update['status'] = status
+                self._last_status = status
+                if error:
+                    self.log.ERROR(status)
+                else:
+                    self.log.INFO(status)
 
-        if not h.empty():
-            self.set(h)
+            if h is None and not update.empty():
+                self.set(update)
+
+    def set_status(self, status):
+        """ Set the device status, keeping track of the published value
+
+        :param status: the new status
+        :return:
+        """
+        with self._count_lock:
+            self._last_status = status
+            self['status'] = status
 
     def evaluate_warn(self, h):
-        """ Evaluate the warn condition, and return it in a Hash
+        """ Evaluate the warn condition, and return it in a Hash.
+        The caller must hold self._count_lock.
 
         :param h: the device reconfiguration Hash
         :return:
         """
-        if self['errorCounter.count'] != self.error_counter.count_error:
+        # Compare to the last published values, not to the device ones
+        count_error = self.error_counter.count_error
+        if self._last_count != count_error:
             # Update in device only if changed
-            h['errorCounter.count'] = self.error_counter.count_error
+            h['errorCounter.count'] = count_error
+            self._last_count = count_error
 
-        if self['errorCounter.fraction'] != self.error_counter.fraction:
+        fraction = self.error_counter.fraction
+        if self._last_fraction != fraction:
             # Update in device only if changed
-            h['errorCounter.fraction'] = self.error_counter.fraction
+            h['errorCounter.fraction'] = fraction
+            self._last_fraction = fraction
 
-        if self['errorCounter.warnCondition'] != self.error_counter.warn:
+        warn = self.error_counter.warn
+        if self._last_warn != warn:
             # Update in device only if changed
-            h['errorCounter.warnCondition'] = self.error_counter.warn
+            h['errorCounter.warnCondition'] = warn
+            self._last_warn = warn
+
+    def start_worker(self, process):
+        """ Start a worker thread, calling process(*args) for each frame
+        passed to submit_to_worker.
+
+        Frames are processed in the worker, whilst the input channel keeps
+        on receiving: only the latest frame is kept if the worker is busy.
+        The device must declare the 'droppedFrames' property, where the
+        number of dropped frames is published.
+        """
+        self._worker_queue = Queue(maxsize=1)
+        self._worker = threading.Thread(
+            target=self._worker_loop, args=(process,), daemon=True)
+        self._worker.start()
+
+    def stop_worker(self):
+        """ Stop the worker thread, discarding any pending frame """
+        if self._worker is None:
+            return
+        self._drop_pending()
+        self._worker_queue.put(None)
+        self._worker.join(timeout=5.)
+        self._worker = None
+
+    def submit_to_worker(self, *args):
+        """ Pass a frame to the worker thread
+
+        :param args: the arguments of the worker's process function
+        :return: False if a pending frame had to be dropped
+        """
+        try:
+            self._worker_queue.put_nowait(args)
+            return True
+        except Full:
+            # Drop the pending (older) frame and queue the new one. The
+            # worker may have taken it in the meantime.
+            dropped = self._drop_pending()
+            if dropped:
+                self.frames_dropped += 1
+            self._worker_queue.put_nowait(args)
+            return not dropped
+
+    def wait_worker(self):
+        """ Wait for the worker to process the pending frame, if any """
+        if self._worker is not None:
+            self._worker_queue.join()
+
+    def _drop_pending(self):
+        # Return True if a pending frame was removed from the queue
+        try:
+            self._worker_queue.get_nowait()
+            self._worker_queue.task_done()
+            return True
+        except Empty:
+            return False
+
+    def _worker_loop(self, process):
+        while True:
+            args = self._worker_queue.get()
+            try:
+                if args is None:
+                    break
+                process(*args)
+            except Exception as e:
+                msg = f"Exception caught in worker thread: {e}"
+                self.update_count(error=True, status=msg)
+            finally:
+                self._worker_queue.task_done()
 
     def refresh_frame_rate_in(self):
         self.frame_rate_in.update()
         fps_in = self.frame_rate_in.refresh()
         if fps_in:
-            self['inFrameRate'] = fps_in
+            h = Hash('inFrameRate', fps_in)
+            if self._worker is not None:
+                h['droppedFrames'] = self.frames_dropped
+            self.set(h)
             self.log.DEBUG(f"Input rate {fps_in} Hz")
@@ -4,20 +4,96 @@
 # Copyright (C) European XFEL GmbH Schenefeld. All rights reserved.
 #############################################################################
 
-from image_processing.image_processing import thumbnail
+import math
+
+import numpy as np
+
 from karabo.bound import (
-    BOOL_ELEMENT, KARABO_CLASSINFO, VECTOR_INT32_ELEMENT, ImageData, State,
-    Timestamp)
+    BOOL_ELEMENT, KARABO_CLASSINFO, UINT32_ELEMENT, VECTOR_INT32_ELEMENT,
+    ImageData, State, Timestamp, Unit)
 
 try:
     from ._version import version as deviceVersion
-    from .common import ImageProcOutputInterface
+    from .common import ImageProcOutputInterface, sum_dtype
     from .ImageProcessorBase import ImageProcessorBase
 except ImportError:
     from imageProcessor._version import version as deviceVersion
-    from imageProcessor.common import ImageProcOutputInterface
+    from imageProcessor.common import ImageProcOutputInterface, sum_dtype
     from imageProcessor.ImageProcessorBase import ImageProcessorBase
 
+# Up to this binning factor, the columns of each bin are summed by adding
+# strided views, which is faster than reducing along a short inner axis.
+MAX_STRIDED_FACTOR = 8
+
+
+def binning_factor(shape, canvas):
+    """Return the smallest integer binning factor, the same along Y and X,
+    needed to fit an image of the given shape in the canvas.
+    """
+    return max(math.ceil(shape[0] / max(canvas[0], 1)),
+               math.ceil(shape[1] / max(canvas[1], 1)), 1)
+
+
+def thumbnail_shape(shape, canvas, resample=False):
+    """Return the shape of the thumbnail of an image with the given shape.
+    """
+    factor = binning_factor(shape, canvas)
+    if resample:
+        # Full bins only
+        return (shape[0] // factor, shape[1] // factor, *shape[2:])
+    return (-(-shape[0] // factor), -(-shape[1] // factor), *shape[2:])
+
+
+def thumbnail(data, canvas, resample=False, out=None):
+    """Return the image downscaled to fit in the canvas.
+
+    :param data: the image, Y and X being the first two axes
+    :param canvas: the shape of the canvas, [height (Y), width (X)]
+    :param resample: if True, the pixels in each bin are averaged, otherwise
+    only the first pixel of each bin is taken
+    :param out: optional buffer for the thumbnail, with the shape returned
+    by thumbnail_shape. If given, the thumbnail is written into it, in its
+    dtype, otherwise averaged pixels are returned as float64 and taken
+    pixels as a view on the image.
+
+    The bins are summed in float32 when this is exact (see sum_dtype),
+    in float64 otherwise.
+    """
+    factor = binning_factor(data.shape, canvas)
+    if factor == 1:
+        # No binning: the image itself is the thumbnail
+        return data
+
+    if not resample:
+        if out is None:
+            return data[::factor, ::factor]
+        np.copyto(out, data[::factor, ::factor])
+        return out
+
+    # Block mean over the full bins. The rows of each bin are summed first,
+    # as whole image rows, then the columns: this is much faster than a
+    # single reduction over both bin axes.
+    height = data.shape[0] // factor
+    width = data.shape[1] // factor
+    rows = data[:height * factor, :width * factor].reshape(
+        height, factor, width * factor, *data.shape[2:])
+    rows = rows.sum(axis=1, dtype=sum_dtype(data.dtype, factor * factor))
+    if factor <= MAX_STRIDED_FACTOR:
+        bin_sum = rows[:, ::factor].copy()
+        for i in range(1, factor):
+            bin_sum += rows[:, i::factor]
+    else:
+        bin_sum = rows.reshape(
+            height, width, factor, *data.shape[2:]).sum(axis=2)
+    # The mean is always evaluated in float64, for it to be truncated
+    # correctly to integers
+    if out is None:
+        return np.divide(bin_sum, factor * factor, dtype=np.float64)
+    # Casting truncates, as astype would do
+    np.divide(bin_sum, factor * factor, out=out, dtype=np.float64,
+              casting='unsafe')
+    return out
+
 
 @KARABO_CLASSINFO("ImageThumbnail", deviceVersion)
 class ImageThumbnail(ImageProcessorBase, ImageProcOutputInterface):
@@ -42,22 +118,64 @@ class ImageThumbnail(ImageProcessorBase, ImageProcOutputInterface):
             .assignmentOptional().defaultValue(False)
             .reconfigurable()
             .commit(),
+
+            UINT32_ELEMENT(expected).key('droppedFrames')
+            .displayedName('Dropped Frames')
+            .description('Number of input frames dropped in the current '
+                         'stream, because the thumbnail of the previous '
+                         'ones was not ready yet.')
+            .unit(Unit.COUNT)
+            .readOnly().initialValue(0)
+            .commit(),
         )
 
     def __init__(self, configuration):
         # always call superclass constructor first!
         super().__init__(configuration)
 
+        # Thumbnail output buffer and ImageData, re-used across frames
+        self._thumb_out = None
+        self._thumb_img = None
+        self._thumb_key = None
+
+        # Bits per pixel and encoding, constant during a stream
+        self._img_format = None
+
+        # Canvas and resample settings, and the thumbnail shape for the
+        # last image shape and settings
+        self._settings = (tuple(configuration['thumbCanvas']),
+                          configuration['resample'])
+        self._plan_key = None
+        self._thumb_shape = None
+
         # Register call-backs
         self.KARABO_ON_DATA("input", self.onData)
         self.KARABO_ON_EOS("input", self.onEndOfStream)
 
+        self.registerInitialFunction(self.initialization)
+
+    def initialization(self):
+        """ This method will be called after the constructor. """
+        self.start_worker(self.process_image)
+
+    def preReconfigure(self, configuration):
+        # always call ImageProcessorBase preReconfigure first!
+        super().preReconfigure(configuration)
+
+        canvas, resample = self._settings
+        if configuration.has('thumbCanvas'):
+            canvas = tuple(configuration['thumbCanvas'])
+        if configuration.has('resample'):
+            resample = configuration['resample']
+        # Replaced at once, as it is read by the worker thread
+        self._settings = (canvas, resample)
+
     def onData(self, data, metaData):
-        first_image = False
         if self['state'] == State.ON:
             self.log.INFO("Start of Stream")
+            self.frames_dropped = 0
+            self['droppedFrames'] = 0
             self.updateState(State.PROCESSING)
-            first_image = True
 
         try:
             image_path = self['imagePath']
@@ -71,37 +189,79 @@ class ImageThumbnail(ImageProcessorBase, ImageProcOutputInterface):
 
             self.refresh_frame_rate_in()
 
-            data = image_data.getData()  # np.ndarray
-            bpp = image_data.getBitsPerPixel()
-            encoding = image_data.getEncoding()
-            d_type = str(data.dtype)
+            # Make the thumbnail in the worker thread
+            self.submit_to_worker(image_data, ts)
+
+        except Exception as e:
+            msg = f"Exception caught in onData: {e}"
+            self.update_count(error=True, status=msg)
 
-            canvas = self['thumbCanvas']
-            resample = self['resample']
-            thumb_array = thumbnail(data, canvas,
-                                    resample=resample).astype(d_type)
+    def process_image(self, image_data, ts):
+        try:
+            data = image_data.getData()  # np.ndarray
+            if self._img_format is None:
+                self._img_format = (image_data.getBitsPerPixel(),
+                                    image_data.getEncoding())
+            bpp, encoding = self._img_format
 
-            thumb_img = ImageData(thumb_array, bitsPerPixel=bpp,
-                                  encoding=encoding)
+            settings = self._settings
+            canvas, resample = settings
+            plan_key = (data.shape, settings)
+            if plan_key != self._plan_key:
+                self._thumb_shape = thumbnail_shape(data.shape, canvas,
+                                                    resample)
+                self._plan_key = plan_key
+            thumb_shape = self._thumb_shape
+            if thumb_shape == data.shape:
+                # Image already fits in canvas
+                thumb_array = data
+            else:
+                # Thumbnail is written in place, in the image dtype
+                out = self.thumbnail_buffer(thumb_shape, data.dtype)
+                thumb_array = thumbnail(data, canvas, resample=resample,
+                                        out=out)
 
-            if first_image:
-                # Update schema
+            thumb_key = (bpp, encoding, thumb_array.shape, thumb_array.dtype)
+            if thumb_key == self._thumb_key:
+                # Only the pixels have changed
+                thumb_img = self._thumb_img
+                thumb_img.setData(thumb_array)
+            else:
+                thumb_img = ImageData(thumb_array, bitsPerPixel=bpp,
+                                      encoding=encoding)
+                self._thumb_img = thumb_img
+                self._thumb_key = thumb_key
+                # First thumbnail of the stream, or new shape: update schema
                 self.updateOutputSchema(thumb_img)
 
             self.writeImageToOutputs(thumb_img, ts)
             self.update_count()  # Success
             self.refresh_frame_rate_out()
-            return
 
         except Exception as e:
-            msg = f"Exception caught in onData: {e}"
+            msg = f"Exception caught while making thumbnail: {e}"
             self.update_count(error=True, status=msg)
-            return
+
+    def thumbnail_buffer(self, shape, dtype):
+        """Return the thumbnail output buffer. A new one is only allocated
+        when shape or dtype change.
+        """
+        out = self._thumb_out
+        if out is None or out.shape != shape or out.dtype != dtype:
+            out = np.empty(shape, dtype=dtype)
+            self._thumb_out = out
+        return out
 
     def onEndOfStream(self, inputChannel):
         self.log.INFO("End of Stream")
+        self.wait_worker()  # Last frame has to be processed first
         self['inFrameRate'] = 0.
+        # Release the thumbnail buffers: the next stream may differ
+        self._thumb_out = None
+        self._thumb_img = None
+        self._thumb_key = None
+        self._img_format = None
         # Signals end of stream
         self.signalEndOfStreams()
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
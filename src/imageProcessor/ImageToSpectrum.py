@@ -6,7 +6,6 @@
 
 import numpy as np
 
-from image_processing.image_processing import imageSumAlongX, imageSumAlongY
 from karabo.middlelayer import (
     AccessMode, Assignment, Bool, Configurable, DaqDataType, DaqPolicy, Device,
     Double, InputChannel, Node, OutputChannel, QuantityValue, Slot, State,
@@ -15,9 +14,11 @@ from processing_utils.rate_calculator import RateCalculator
 
 try:
     from ._version import version as deviceVersion
+    from .common import sum_dtype
     from .common_mdl import ErrorNode
 except ImportError:
     from imageProcessor._version import version as deviceVersion
+    from imageProcessor.common import sum_dtype
     from imageProcessor.common_mdl import ErrorNode
 
 
@@ -40,10 +41,17 @@ class ImageToSpectrum(Device):
     def __init__(self, configuration):
         super().__init__(configuration)
         self.output.noInputShared = "drop"
-        if self.xIntegral:
-            self.calculate_spectrum = imageSumAlongX
-        else:
-            self.calculate_spectrum = imageSumAlongY
+        # Integrating in X means summing the pixels of each row
+        self.sum_axis = 1 if self.xIntegral else 0
+        # Spectrum and accumulator buffers, re-used across frames
+        self._spectrum = None
+        self._accumulator = None
+        # Last image type, and its numpy dtype
+        self._img_type = None
+        self._dtype = None
+        # ROI slices, for the last image shape
+        self._roi_slices = None
+        self._roi_shape = None
 
     # TODO base class for MDL: interfaces, frameRate, errorCounter, input
 
@@ -78,7 +86,10 @@ class ImageToSpectrum(Device):
             ts = get_timestamp(meta.timestamp.timestamp)
             img_raw = data["data.image.pixels"]
             img_type = img_raw["type"]
-            dtype = np.dtype(Type.types[img_type].numpy)
+            if img_type != self._img_type:
+                self._dtype = np.dtype(Type.types[img_type].numpy)
+                self._img_type = img_type
+            dtype = self._dtype
             shape = img_raw["shape"]
 
             # Convert bare Hash to NDArray
@@ -91,21 +102,36 @@ class ImageToSpectrum(Device):
             if fps:
                 self.frameRate = fps
 
-            low_x = np.maximum(self.roi[0], 0)
-            high_x = np.minimum(self.roi[1], image_width)
-            low_y = np.maximum(self.roi[2], 0)
-            high_y = np.minimum(self.roi[3], image_height)
-
             # Apply ROI
-            if low_x == 0 and high_x == 0 and low_y == 0 and high_y == 0:
-                # In case of [0, 0, 0 , 0] no ROI is applied
+            roi_shape = (image_height, image_width)
+            if roi_shape != self._roi_shape:
+                self._roi_slices = self.roi_slices(image_width, image_height)
+                self._roi_shape = roi_shape
+            if self._roi_slices is None:
+                # Whole image
                 cropped_image = image
             else:
-                cropped_image = image[int(low_y):int(high_y),
-                                      int(low_x):int(high_x)]
-
-            # Calculate spectrum
-            spectrum = self.calculate_spectrum(cropped_image)
+                cropped_image = image[self._roi_slices]
+
+            # Calculate spectrum, in place. Integer pixels are summed in
+            # float32 when exact, which is faster, then converted.
+            size = cropped_image.shape[1 - self.sum_axis]
+            spectrum = self.spectrum_buffer(size)
+            acc_dtype = sum_dtype(dtype, cropped_image.shape[self.sum_axis])
+            if acc_dtype == spectrum.dtype:
+                accumulator = spectrum
+            else:
+                accumulator = self.accumulator_buffer(size, acc_dtype)
+            if self.sum_axis == 1:
+                # Summing along rows: einsum's inner loop is faster than
+                # np.add.reduce, given an explicit float dtype
+                np.einsum('ij->i', cropped_image, dtype=acc_dtype,
+                          out=accumulator)
+            else:
+                np.add.reduce(cropped_image, axis=0, dtype=acc_dtype,
+                              out=accumulator)
+            if accumulator is not spectrum:
+                np.copyto(spectrum, accumulator)
 
             # Calculate integral
             self.spectrumIntegral = QuantityValue(spectrum.sum(),
@@ -124,8 +150,9 @@ class ImageToSpectrum(Device):
                 self.log.ERROR(msg)
             self.errorCounter.update_count(True)
 
-        # Write spectrum to output channel
-        self.output.schema.data.spectrum = spectrum.astype('double').tolist()
+        # Write spectrum to output channel. It is already a float64 array,
+        # which VectorDouble takes as it is.
+        self.output.schema.data.spectrum = spectrum
 
         await self.output.writeData(timestamp=ts)
 
@@ -148,6 +175,8 @@ class ImageToSpectrum(Device):
         defaultValue=roi_default,
     )
     def roi(self, value):
+        # The ROI slices will be re-evaluated
+        self._roi_shape = None
         if self.valid_roi(value):
             self.roi = value
         elif self.roi.value is None:
@@ -183,6 +212,42 @@ class ImageToSpectrum(Device):
         if self.state != State.ON:
             self.state = State.ON
 
+    def spectrum_buffer(self, size):
+        """Return the spectrum buffer. A new one is only allocated when the
+        spectrum size changes.
+        """
+        if self._spectrum is None or self._spectrum.size != size:
+            self._spectrum = np.empty(size, dtype=np.float64)
+        return self._spectrum
+
+    def accumulator_buffer(self, size, dtype):
+        """Return the buffer for summing the pixels in the given dtype. A
+        new one is only allocated when the size or the dtype changes.
+        """
+        accumulator = self._accumulator
+        if (accumulator is None or accumulator.size != size or
+                accumulator.dtype != dtype):
+            self._accumulator = accumulator = np.empty(size, dtype=dtype)
+        return accumulator
+
+    def roi_slices(self, image_width, image_height):
+        """Return the slices selecting the ROI in an image of the given
+        size, or None if the ROI is the whole image.
+        """
+        low_x, high_x, low_y, high_y = (int(v) for v in self.roi.value)
+        if low_x == 0 and high_x == 0 and low_y == 0 and high_y == 0:
+            # In case of [0, 0, 0 , 0] no ROI is applied
+            return None
+        low_x = max(low_x, 0)
+        high_x = min(high_x, image_width)
+        low_y = max(low_y, 0)
+        high_y = min(high_y, image_height)
+        if (low_x == 0 and high_x == image_width and low_y == 0 and
+                high_y == image_height):
+            # The ROI covers the whole image
+            return None
+        return (slice(low_y, high_y), slice(low_x, high_x))
+
     def valid_roi(self, roi):
         if any([roi[0] < 0, roi[1] < roi[0], roi[2] < 0, roi[3] < roi[2]]):
             return False
@@ -404,7 +404,7 @@ class SimpleImageProcessor(PythonDevice):
         h.set("success", False)
 
         self.counter += 1
-        currentTime = time.time()
+        currentTime = time.monotonic()
         if self.lastTime is None:
             self.counter = 0
             self.lastTime = currentTime
@@ -4,24 +4,27 @@
 # Copyright (C) European XFEL GmbH Schenefeld. All rights reserved.
 #############################################################################
 
-from image_processing.image_processing import (
-    imageSumAlongY, peakParametersEval)
+import numpy as np
+
 from karabo.bound import (
     DOUBLE_ELEMENT, KARABO_CLASSINFO, UINT32_ELEMENT, VECTOR_UINT32_ELEMENT,
     Hash, State, Timestamp, Unit)
 
 try:
     from ._version import version as deviceVersion
+    from .common import peak_parameters
     from .ImageProcessorBase import ImageProcessorBase
 except ImportError:
     from imageProcessor._version import version as deviceVersion
+    from imageProcessor.common import peak_parameters
     from imageProcessor.ImageProcessorBase import ImageProcessorBase
 
 
 def find_peaks(img_x, zero_point):
     """Find two peaks - one left one right - from zero_point"""
-    value_1, pos_1, fwhm_1 = peakParametersEval(img_x[zero_point::-1])
-    value_2, pos_2, fwhm_2 = peakParametersEval(img_x[zero_point:])
+    # The left side is scanned through a reversed view, without copy
+    value_1, pos_1, fwhm_1 = peak_parameters(img_x[zero_point::-1])
+    value_2, pos_2, fwhm_2 = peak_parameters(img_x[zero_point:])
     pos_1 = zero_point - pos_1
     pos_2 += zero_point
 
@@ -35,6 +38,19 @@ class TwoPeakFinder(ImageProcessorBase):
         # always call superclass constructor first!
         super().__init__(configuration)
 
+        # Zero point and ROI, updated in preReconfigure
+        self._zero_point = configuration['zeroPoint']
+        self._roi = configuration['roi']
+
+        # Integral along Y, re-used across frames
+        self._img_x = None
+
+        # Device updates, re-used across frames: values are overwritten
+        self._hash = Hash(
+            'peak1Value', 0.0, 'peak1Position', 0, 'peak1Fwhm', 0,
+            'peak2Value', 0.0, 'peak2Position', 0, 'peak2Fwhm', 0,
+            'peakRatio', 0.0)
+
         # Register call-backs
         self.KARABO_ON_DATA("input", self.onData)
         self.KARABO_ON_EOS("input", self.onEndOfStream)
@@ -114,7 +130,7 @@ class TwoPeakFinder(ImageProcessorBase):
             DOUBLE_ELEMENT(expected).key('peakRatio')
             .displayedName("Peak Ratio")
             .description("Amplitude of the 1st peak divided by amplitude of "
-                         "the second peak.")
+                         "the second peak. 0 if the latter is not positive.")
             .unit(Unit.NUMBER)
             .readOnly()
             .commit(),
@@ -124,6 +140,15 @@ class TwoPeakFinder(ImageProcessorBase):
     #   Implementation of Callbacks              #
     ##############################################
 
+    def preReconfigure(self, configuration):
+        # always call ImageProcessorBase preReconfigure first!
+        super().preReconfigure(configuration)
+
+        if configuration.has('zeroPoint'):
+            self._zero_point = configuration['zeroPoint']
+        if configuration.has('roi'):
+            self._roi = configuration['roi']
+
     def onData(self, data, metaData):
         if self['state'] == State.ON:
             self.log.INFO("Start of Stream")
@@ -148,7 +173,7 @@ class TwoPeakFinder(ImageProcessorBase):
         self.log.INFO("End of Stream")
         self['inFrameRate'] = 0.
         self.updateState(State.ON)
-        self['status'] = 'Idle'
+        self.set_status('Idle')
 
     ##############################################
     #   Implementation of process_image          #
@@ -159,8 +184,8 @@ class TwoPeakFinder(ImageProcessorBase):
 
         try:
             img = image_data.getData()  # np.ndarray
-            zero_point = self['zeroPoint']
-            roi = self['roi']
+            zero_point = self._zero_point
+            roi = self._roi
 
             if roi and len(roi) == 2 and roi[1] > roi[0] >= 0:
                 low_x = roi[0]
@@ -168,24 +193,27 @@ class TwoPeakFinder(ImageProcessorBase):
                 if zero_point <= low_x or zero_point >= high_x:
                     raise RuntimeError("zero_point is outside ROI.")
 
-                # sum along y axis
-                img_x = imageSumAlongY(img[:, low_x:high_x + 1])
+                img = img[:, low_x:high_x + 1]
             else:
                 # No valid ROI
                 low_x = 0
-                img_x = imageSumAlongY(img)
+
+            # sum along y axis, in place
+            img_x = self.sum_buffer(img.shape[1])
+            np.add.reduce(img, axis=0, dtype=np.float64, out=img_x)
 
             peaks = find_peaks(img_x, zero_point - low_x)
 
-            h = Hash()
+            h = self._hash
             h.set('peak1Value', peaks[0])
             h.set('peak1Position', low_x + peaks[1])
             h.set('peak1Fwhm', peaks[2])
             h.set('peak2Value', peaks[3])
             h.set('peak2Position', low_x + peaks[4])
             h.set('peak2Fwhm', peaks[5])
-            if peaks[3] > 0.0:
-                h.set('peakRatio', peaks[0] / peaks[3])
+            # The ratio is 0 when the 2nd peak is not positive
+            h.set('peakRatio',
+                  peaks[0] / peaks[3] if peaks[3] > 0.0 else 0.0)
             self.set(h, ts)
 
             self.update_count()  # Success
@@ -193,3 +221,11 @@ class TwoPeakFinder(ImageProcessorBase):
         except Exception as e:
             msg = f"Exception caught in process_image: {e}"
             self.update_count(error=True, status=msg)
+
+    def sum_buffer(self, size):
+        """Return the buffer for the integral along Y. A new one is only
+        allocated when its size changes.
+        """
+        if self._img_x is None or self._img_x.size != size:
+            self._img_x = np.empty(size, dtype=np.float64)
+        return self._img_x
@@ -4,7 +4,7 @@
 # Copyright (C) European XFEL GmbH Schenefeld. All rights reserved.
 #############################################################################
 
-from queue import Queue
+from collections import deque
 
 import numpy as np
 
@@ -22,6 +22,14 @@ class ImageProcOutputInterface(NoFsm):
 
         self.shape = None
         self.kType = None
+        # Shape and dtype of the data the schema was last checked for
+        self._schema_key = None
+
+        # Output Hashes, and DAQ ImageData, re-used across frames
+        self._pp_hash = Hash()
+        self._daq_hash = Hash()
+        self._daq_img = None
+        self._daq_key = None
 
         # Output frame rate
         self.frame_rate_out = RateCalculator(refresh_interval=1.0)
@@ -58,11 +66,17 @@ class ImageProcOutputInterface(NoFsm):
 
         if isinstance(imageData, ImageData):
             pixels = imageData.getData()  # np.ndarray
+            schema_key = (pixels.shape, pixels.dtype)
+            if schema_key == self._schema_key:
+                return  # same data as last time, schema unchanged
             shape = pixels.shape
             kType = imageData.getType()
             updateSchemaHelper = self.updateImageSchemaHelper
         elif isinstance(imageData, np.ndarray):
-            pixels = imageData
+            # The NDArray schema does not depend on the dtype
+            schema_key = (imageData.shape, None)
+            if schema_key == self._schema_key:
+                return  # same data as last time, schema unchanged
             shape = imageData.shape
             kType = Types.NUMPY
             updateSchemaHelper = self.updateNDArraySchemaHelper
@@ -70,6 +84,7 @@ class ImageProcOutputInterface(NoFsm):
             raise RuntimeError("Trying to update schema with invalid "
                                "imageData")
 
+        self._schema_key = schema_key
         if shape == self.shape and kType == self.kType:
             return  # schema unchanged no need to update
 
@@ -138,13 +153,25 @@ class ImageProcOutputInterface(NoFsm):
                 "Trying to feed writeImageToOutputs with invalid imageData")
 
         # write data to output channel
-        self.writeChannel('ppOutput', Hash("data.image", img), timestamp)
-
-        # swap image dimensions for DAQ compatibility
-        daqImg = ImageData(img.getData().reshape(self.daqShape))
+        self._pp_hash["data.image"] = img
+        self.writeChannel('ppOutput', self._pp_hash, timestamp)
+
+        # swap image dimensions for DAQ compatibility. For contiguous
+        # images, reshape returns a view and does not copy the pixels.
+        pixels = img.getData().reshape(self.daqShape)
+        daq_key = (pixels.shape, pixels.dtype)
+        if daq_key == self._daq_key:
+            # Only the pixels have changed
+            daqImg = self._daq_img
+            daqImg.setData(pixels)
+        else:
+            daqImg = ImageData(pixels)
+            self._daq_img = daqImg
+            self._daq_key = daq_key
 
         # send data to DAQ output channel
-        self.writeChannel('daqOutput', Hash("data.image", daqImg), timestamp)
+        self._daq_hash["data.image"] = daqImg
+        self.writeChannel('daqOutput', self._daq_hash, timestamp)
 
     def writeNDArrayToOutputs(self, array, timestamp=None):
         """Write the array to all the output channels"""
@@ -152,9 +179,10 @@ class ImageProcOutputInterface(NoFsm):
             raise RuntimeError(
                 "Trying to feed writeNDArrayToOutputs with invalid "
                 "NDArray data")
-        self.writeChannel('ppOutput', Hash("data.image", array), timestamp)
-        daqArray = array.reshape(self.daqShape)
-        self.writeChannel('daqOutput', Hash("data.image", daqArray), timestamp)
+        self._pp_hash["data.image"] = array
+        self.writeChannel('ppOutput', self._pp_hash, timestamp)
+        self._daq_hash["data.image"] = array.reshape(self.daqShape)
+        self.writeChannel('daqOutput', self._daq_hash, timestamp)
 
     def signalEndOfStreams(self):
         """Signals end-of-stream to all the output channels"""
@@ -170,50 +198,87 @@ class ImageProcOutputInterface(NoFsm):
 
 
 class ErrorCounter:
+    __slots__ = ('queue', 'count_error', 'last_warn_condition', 'threshold',
+                 'epsilon', '_fraction')
+
     def __init__(self, window_size=100, threshold=0.1, epsilon=0.01):
-        self.queue = Queue(maxsize=window_size)
+        # Sliding window of the last results
+        self.queue = deque(maxlen=window_size)
         self.count_error = 0
+        # Error fraction, updated at each append
+        self._fraction = 0.
         self.last_warn_condition = False
         self.threshold = threshold
         self.epsilon = epsilon
 
     def append(self, error=False):
-        if self.size == self.queue.maxsize:
-            # queue full - pop first and update counters
-            _error = self.queue.get(block=False)
-            if _error and self.count_error > 0:
+        if len(self.queue) == self.queue.maxlen:
+            # window full - the first element will be dropped by append
+            if self.queue[0] and self.count_error > 0:
                 self.count_error -= 1
 
-        self.queue.put(error, block=False)
+        self.queue.append(error)
         if error:
             self.count_error += 1
+        self._fraction = self.count_error / len(self.queue)
 
     def clear(self):
-        while self.size > 0:
-            # pop all elements
-            self.queue.get(block=False)
+        self.queue.clear()
         self.count_error = 0
+        self._fraction = 0.
         self.last_warn_condition = False
 
     @property
     def size(self):
-        return self.queue.qsize()
+        return len(self.queue)
 
     @property
     def fraction(self):
-        if self.size == 0:
-            return 0.
-        else:
-            return self.count_error / self.size
+        return self._fraction
 
     @property
     def warn(self):
+        fraction = self._fraction
         if self.last_warn_condition:
             # Go out of warn when fraction <= threshold - epsilon
-            new_warn = self.fraction > self.threshold - self.epsilon
+            new_warn = fraction > self.threshold - self.epsilon
         else:
             # Enter warn when fraction >= threshold + epsilon
-            new_warn = self.fraction >= self.threshold + self.epsilon
+            new_warn = fraction >= self.threshold + self.epsilon
 
         self.last_warn_condition = new_warn
         return new_warn
+
+
+def peak_parameters(data):
+    """Evaluate the parameters of the highest peak of a 1D distribution,
+    without fitting.
+
+    :param data: the distribution
+    :return: the peak amplitude, the peak position and the full width at
+    half maximum. The FWHM is the distance between the first samples
+    not above half maximum, on the left and on the right of the peak.
+    """
+    peak = int(np.argmax(data))
+    amplitude = data[peak]
+    half_max = amplitude / 2
+
+    # Last sample not above half maximum on the left of the peak, ...
+    below = np.flatnonzero(data[:peak] <= half_max)
+    left = int(below[-1]) if below.size else 0
+    # ... and first one on the right
+    below = np.flatnonzero(data[peak + 1:] <= half_max)
+    right = peak + 1 + int(below[0]) if below.size else data.size - 1
+
+    return amplitude, peak, right - left
+
+
+def sum_dtype(dtype, size):
+    """Return the dtype for summing `size` pixels of the given dtype.
+
+    float32 is used for integer pixels when the sum is exact, i.e. when its
+    magnitude cannot exceed 2**24, and float64 otherwise.
+    """
+    if dtype.kind in 'ui' and (1 << 8 * dtype.itemsize) * size <= 1 << 24:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
@@ -98,14 +98,20 @@ class ErrorNode(Configurable):
         self.evaluate_warn()
 
     def evaluate_warn(self):
-        if self.count != self.error_counter.count_error:
+        # The warn condition is evaluated once, as it has a state
+        error_counter = self.error_counter
+        count_error = error_counter.count_error
+        fraction = error_counter.fraction
+        warn = error_counter.warn
+
+        if self.count != count_error:
             # Update in device only if changed
-            self.count = self.error_counter.count_error
+            self.count = count_error
 
-        if self.fraction != self.error_counter.fraction:
+        if self.fraction != fraction:
             # Update in device only if changed
-            self.fraction = self.error_counter.fraction
+            self.fraction = fraction
 
-        if self.warnCondition != self.error_counter.warn:
+        if self.warnCondition != warn:
             # Update in device only if changed
-            self.warnCondition = self.error_counter.warn
+            self.warnCondition = warn
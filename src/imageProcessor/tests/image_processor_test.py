@@ -6,9 +6,15 @@
 
 import unittest
 
+import numpy as np
+
 from karabo.bound import AlarmCondition, Configurator, Hash, PythonDevice
 
-from ..ImageProcessor import ImageProcessor
+from ..common import peak_parameters
+from ..ImageProcessor import (
+    ImageProcessor, bin_2x2, cap_bin_count, centre_of_mass,
+    coarse_start_values, min_max_mean, set_threshold, subtract_background,
+    sum_along_x, sum_along_y, sum_dtype)
 
 
 class ImageProcessorTestCase(unittest.TestCase):
@@ -41,6 +47,20 @@ class ImageProcessorTestCase(unittest.TestCase):
         self.assertEqual(proc['errorCounter.warnCondition'], 0)
         self.assertEqual(proc['alarmCondition'], AlarmCondition.NONE)
 
+    def test_cached_config(self):
+        proc = Configurator(PythonDevice).create("ImageProcessor", Hash(
+            "Logger.priority", "WARN",
+            "deviceId", "ImageProcessor_0"))
+        self.assertTrue(proc._cfg["doCOfM"])
+
+        proc.preReconfigure(Hash("doCOfM", False))
+        self.assertFalse(proc._cfg["doCOfM"])
+
+        # invalid range is discarded, thus not cached
+        udr = proc._cfg["userDefinedRange"]
+        proc.preReconfigure(Hash("userDefinedRange", [10, 0, 0, 10]))
+        self.assertEqual(proc._cfg["userDefinedRange"], udr)
+
     def test_auto_fit_range(self):
         res = ImageProcessor.auto_fit_range(x0=5, y0=5, sx=2, sy=2, sigmas=1,
                                             image_width=10, image_height=10)
@@ -64,6 +84,146 @@ class ImageProcessorTestCase(unittest.TestCase):
                                             min_range=4)
         self.assertEqual(res, (4, 16, 0, 10))
 
+        res = ImageProcessor.auto_fit_range(
+            x0=np.float64(50.5), y0=np.float64(50.5), sx=np.float64(5.),
+            sy=np.float64(5.), sigmas=3, image_width=100, image_height=100)
+        self.assertEqual(res, (35, 65, 35, 65))
+        self.assertTrue(all(type(val) is int for val in res))
+
+    def test_min_max_mean(self):
+        rng = np.random.default_rng(0)
+        for shape in [(10, 10), (1024, 1024), (100000,)]:
+            img = rng.integers(0, 4096, shape, dtype=np.uint16)
+            img_min, img_max, img_mean = min_max_mean(img)
+            self.assertEqual(img_min, img.min())
+            self.assertEqual(img_max, img.max())
+            self.assertAlmostEqual(img_mean, img.mean())
+
+        # NaN pixels propagate to min and max, as with ndarray.min/max
+        img = rng.random((1024, 1024))
+        img[1000, 10] = np.nan
+        img_min, img_max, img_mean = min_max_mean(img)
+        self.assertTrue(np.isnan(img_min))
+        self.assertTrue(np.isnan(img_max))
+
+    def test_centre_of_mass(self):
+        idx = np.arange(200, dtype=np.float64)
+        indices = (idx, idx * idx)
+
+        y, x = np.mgrid[0:100, 0:200]
+        img = np.exp(-(x - 80.)**2 / (2 * 10.**2)
+                     - (y - 40.)**2 / (2 * 5.**2))
+        x0, y0, sx, sy = centre_of_mass(img, indices)
+        self.assertAlmostEqual(x0, 80., places=3)
+        self.assertAlmostEqual(y0, 40., places=3)
+        self.assertAlmostEqual(sx, 10., places=3)
+        self.assertAlmostEqual(sy, 5., places=3)
+
+        x0, sx = centre_of_mass(img[40], indices)
+        self.assertAlmostEqual(x0, 80., places=3)
+        self.assertAlmostEqual(sx, 10., places=3)
+
+    def test_subtract_background(self):
+        rng = np.random.default_rng(0)
+        img = rng.integers(0, 4096, (100, 64), dtype=np.uint16)
+        bkg = rng.integers(0, 512, (100, 64), dtype=np.uint16)
+        expected = np.where(img > bkg, img - bkg, 0)
+        img_min = subtract_background(img, bkg, with_min=True,
+                                      chunk_bytes=1024)
+        np.testing.assert_array_equal(img, expected)
+        self.assertEqual(img_min, expected.min())
+
+        self.assertIsNone(subtract_background(img, bkg))
+
+    def test_bin_2x2(self):
+        img = np.arange(35, dtype=np.uint16).reshape(5, 7)
+        binned = bin_2x2(img)
+        self.assertEqual(binned.shape, (2, 3))
+        self.assertEqual(binned[0, 0], (0 + 1 + 7 + 8) / 4)
+        self.assertEqual(binned[1, 2], (18 + 19 + 25 + 26) / 4)
+
+    def test_coarse_start_values(self):
+        def fit(data, p0, enablePolynomial):
+            # "fits" a gaussian at (10, 20) with sigma (3, 4) in binned image
+            self.assertEqual(data.shape, (150, 200))
+            self.assertEqual(p0, (1., 9.75, 19.75, 2.5, 3.5))
+            return (5., 10., 20., 3., 4.), None, 1
+
+        data = np.zeros((300, 400))
+        p0 = coarse_start_values(fit, data, (1., 20., 40., 5., 7.), 5, False)
+        self.assertEqual(p0, (5., 20.5, 40.5, 6., 8.))
+
+        # small image: unchanged initial parameters
+        p0 = coarse_start_values(fit, data[:10], None, 5, False)
+        self.assertIsNone(p0)
+
+    def test_sum_along_y(self):
+        rng = np.random.default_rng(0)
+        for shape in [(10, 20), (2000, 1000)]:
+            img = rng.integers(0, 4096, shape, dtype=np.uint16)
+            img_x = sum_along_y(img)
+            self.assertEqual(img_x.dtype, np.float64)
+            np.testing.assert_array_equal(img_x, img.sum(axis=0))
+
+    def test_sum_along_x(self):
+        img = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        out_dtype = sum_dtype(img.dtype, img.shape[1])
+        self.assertEqual(out_dtype, np.float32)
+        img_y = sum_along_x(img, out=np.empty(3, dtype=out_dtype))
+        self.assertEqual(img_y.dtype, np.float32)
+        np.testing.assert_array_equal(img_y, img.sum(axis=1))
+
+        # float32 would not be exact
+        self.assertEqual(sum_dtype(np.dtype(np.uint16), 1000), np.float64)
+        self.assertEqual(sum_dtype(np.dtype(np.float32), 10), np.float64)
+
+    def test_set_threshold(self):
+        img = np.arange(12, dtype=np.uint16).reshape(3, 4)
+        out = np.full_like(img, 99)
+        img2 = set_threshold(img, 5, out=out)
+        self.assertIs(img2, out)
+        np.testing.assert_array_equal(img2, np.where(img < 5, 0, img))
+        # the input image is left untouched
+        np.testing.assert_array_equal(img, np.arange(12).reshape(3, 4))
+
+    def test_cap_bin_count(self):
+        img = np.array([0, 1, 1, 65534, 65535, 65535], dtype=np.uint16)
+        px_freq = cap_bin_count(np.bincount(img), 65535)
+        self.assertEqual(px_freq.size, 65535)
+        self.assertEqual(px_freq[1], 2)
+        # 65534 and 65535 both counted in the last bin
+        self.assertEqual(px_freq[-1], 3)
+        self.assertEqual(px_freq.sum(), img.size)
+
+        px_freq = cap_bin_count(np.bincount(img[:3]), 65535)
+        self.assertEqual(px_freq.size, 2)
+
+    def test_peak_parameters(self):
+        data = np.array([0, 1, 2, 6, 10, 7, 4, 1, 0], dtype=np.float64)
+        ampl, peak, fwhm = peak_parameters(data)
+        self.assertEqual(ampl, 10)
+        self.assertEqual(peak, 4)
+        # half maximum crossed at indices 2 and 6
+        self.assertEqual(fwhm, 4)
+
+        # peak at the edge
+        ampl, peak, fwhm = peak_parameters(data[4:])
+        self.assertEqual(peak, 0)
+        self.assertEqual(fwhm, 2)
+
+        # flat profile: the FWHM is not zero
+        ampl, peak, fwhm = peak_parameters(np.zeros(9))
+        self.assertEqual(peak, 0)
+        self.assertEqual(fwhm, 1)
+
+        # negative profile, e.g. after background subtraction
+        data = np.array([-5, -3, -1, -2, -4], dtype=np.float64)
+        ampl, peak, fwhm = peak_parameters(data)
+        self.assertEqual(ampl, -1)
+        self.assertEqual(peak, 2)
+        # half maximum (-0.5) crossed at indices 1 and 3
+        self.assertEqual(fwhm, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,9 +6,11 @@
 
 import unittest
 
+import numpy as np
+
 from karabo.bound import Configurator, Hash, PythonDevice
 
-from ..ImageThumbnail import ImageThumbnail
+from ..ImageThumbnail import ImageThumbnail, thumbnail, thumbnail_shape
 
 
 class ImageThumbnail_TestCase(unittest.TestCase):
@@ -18,6 +20,39 @@ class ImageThumbnail_TestCase(unittest.TestCase):
             "deviceId", "ImageThumbnail_0"))
         proc.startFsm()
 
+    def test_thumbnail(self):
+        img = np.arange(10 * 12, dtype=np.uint16).reshape(10, 12)
+
+        # fits already in canvas
+        self.assertIs(thumbnail(img, [10, 12]), img)
+
+        # binning 3 along both axes, 1st pixel of each bin
+        thumb = thumbnail(img, [4, 6])
+        np.testing.assert_array_equal(thumb, img[::3, ::3])
+        self.assertEqual(thumb.shape, (4, 4))
+
+        # resampling: mean over the full bins
+        thumb = thumbnail(img, [4, 6], resample=True)
+        self.assertEqual(thumb.shape, (3, 4))
+        self.assertEqual(thumb[0, 0], img[:3, :3].mean())
+        self.assertEqual(thumb[2, 3], img[6:9, 9:12].mean())
+
+        # large binning factor, and RGB image
+        img2 = np.arange(40 * 30 * 3, dtype=np.uint8).reshape(40, 30, 3)
+        thumb = thumbnail(img2, [3, 2], resample=True)
+        self.assertEqual(thumb.shape, (2, 2, 3))
+        np.testing.assert_array_equal(
+            thumb[1, 0], img2[15:30, :15].mean(axis=(0, 1)))
+
+        # in place, in the image dtype
+        for resample in (False, True):
+            shape = thumbnail_shape(img.shape, [4, 6], resample)
+            out = np.empty(shape, dtype=img.dtype)
+            thumb = thumbnail(img, [4, 6], resample=resample, out=out)
+            self.assertIs(thumb, out)
+            np.testing.assert_array_equal(
+                thumb, thumbnail(img, [4, 6], resample).astype(img.dtype))
+
 
 if __name__ == '__main__':
     unittest.main()